@@ -1,9 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, session, jsonify, abort, make_response, g, has_request_context
 import sqlite3
 from datetime import datetime, timedelta
 from markdown_it import MarkdownIt
 import os
 import re
+import heapq
+import gzip
+import hashlib
+import difflib
+import hmac
+import math
+import zlib
+import codecs
+import io
 # 在文件顶部添加一个自定义函数来指定哈希算法
 from werkzeug.security import generate_password_hash as werkzeug_generate_password_hash, check_password_hash
 
@@ -31,6 +40,13 @@ logger = logging.getLogger(__name__)
 # 在文件顶部添加以下导入
 import os
 import sys
+import json
+import click
+from markupsafe import Markup
+from ratelimit import RateLimiter
+from fragment_cache import FragmentCache, LRUCache
+from tag_index import TagIndex
+from profiler import RequestProfiler
 
 # 修改为使用绝对路径
 if getattr(sys, 'frozen', False):
@@ -43,10 +59,101 @@ else:
     app = Flask(__name__)
 
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+# 每篇文章预先计算并保存的相关文章数量
+app.config['RELATED_POSTS_LIMIT'] = 5
+# 作者页和归档页每页显示的文章数量
+app.config['ARCHIVE_PER_PAGE'] = 10
+
+# 管理员配置：用户名在ADMIN_USERNAMES中的登录用户，或请求头X-Admin-Token与ADMIN_TOKEN一致的请求可以访问管理接口
+app.config['ADMIN_USERNAMES'] = set()
+app.config['ADMIN_TOKEN'] = os.environ.get('BLOG_ADMIN_TOKEN')
+
+# 高开销接口的限流配置
+app.config['RATE_LIMIT_ENABLED'] = True
+# 限流状态后端：'sqlite'在同一台机器的多个worker进程之间共享，'memory'只在当前进程内生效
+app.config['RATE_LIMIT_BACKEND'] = 'sqlite'
+app.config['RATE_LIMIT_DB'] = 'ratelimit.db'
+# 令牌桶规则：{规则名: (每秒补充的令牌数, 桶容量)}，分别按客户端IP和用户计算
+app.config['RATE_LIMITS'] = {
+    'search': (0.5, 10),
+    'deep_page': (0.2, 5),
+    'login': (5 / 60, 5),
+    'register': (1 / 60, 3),
+}
+# 全局并发数限制：{规则名: 最大同时处理的请求数}
+app.config['RATE_LIMIT_CONCURRENCY'] = {
+    'search': 4,
+}
+# 超过该页码的首页翻页请求视为深度分页
+app.config['DEEP_PAGE_THRESHOLD'] = 10
+
+# 文章正文压缩配置：超过阈值（字节）的正文使用zlib压缩后保存
+app.config['CONTENT_COMPRESSION'] = True
+app.config['CONTENT_COMPRESSION_THRESHOLD'] = 4096
+app.config['CONTENT_COMPRESSION_LEVEL'] = 6
+
+# 文章历史版本配置：每隔多少个版本保存一次完整快照，每篇文章最多保留多少个版本
+app.config['REVISION_SNAPSHOT_INTERVAL'] = 10
+app.config['REVISION_KEEP'] = 50
+
+# Markdown实时预览配置：单次预览的最大字符数，按内容哈希缓存的渲染结果数量、总字节数，
+# 以及单个块渲染结果的最大字节数（更大的块每次重新渲染，不占用缓存）
+app.config['PREVIEW_MAX_LENGTH'] = 200000
+app.config['PREVIEW_CACHE_SIZE'] = 2048
+app.config['PREVIEW_CACHE_MAX_BYTES'] = 8 * 1024 * 1024
+app.config['PREVIEW_CACHE_MAX_BLOCK_BYTES'] = 16 * 1024
+
+# 请求性能分析配置：默认关闭，可以通过/admin/profile在运行时开启
+# 管理员也可以在请求中带上X-Profile请求头，单独分析这一个请求
+app.config['PROFILER_ENABLED'] = False
+app.config['PROFILER_SAMPLE_RATE'] = 0.01
+# 'cprofile'记录完整的函数调用统计，'sample'定时采样调用栈（开销更低），'both'同时使用
+app.config['PROFILER_MODE'] = 'cprofile'
+app.config['PROFILER_SAMPLE_INTERVAL'] = 0.005
+
+# 文章页流式输出配置：正文（UTF-8编码）超过此字节数时，先发送页头和标题，正文边渲染边发送
+# 也可以通过?stream=1或?stream=0强制开启或关闭
+app.config['POST_STREAM_MIN_SIZE'] = 64 * 1024
+
+# JSON接口配置：每页最多返回的文章数量，响应超过多少字节时使用gzip压缩
+app.config['API_MAX_LIMIT'] = 100
+app.config['API_GZIP_MIN_SIZE'] = 1024
+
+# 页面片段缓存配置，缓存文件由同一台机器上的所有worker进程共享
+app.config['FRAGMENT_CACHE_ENABLED'] = True
+app.config['FRAGMENT_CACHE_DB'] = 'fragment_cache.db'
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
 
 # 初始化Markdown解析器
 md = MarkdownIt()
 
+# 初始化限流器
+rate_limiter = RateLimiter(app)
+
+# 初始化页面片段缓存
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_DB'], app.config['FRAGMENT_CACHE_MAX_BYTES'])
+
+# 初始化Markdown预览缓存（按块内容的哈希缓存渲染结果）
+preview_cache = LRUCache(app.config['PREVIEW_CACHE_SIZE'], app.config['PREVIEW_CACHE_MAX_BYTES'],
+                         app.config['PREVIEW_CACHE_MAX_BLOCK_BYTES'])
+
+# 初始化标签倒排索引（首次查询时从数据库构建）
+tag_index = TagIndex()
+
+# 拆分Markdown块时使用的正则表达式
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+LIST_ITEM_RE = re.compile(r'^ {0,3}([*+-]|\d+[.)])\s')
+REFERENCE_RE = re.compile(r'^ {0,3}\[[^\]]+\]:', re.M)
+# 可以包含空行的HTML块（CommonMark中的第1-5类）：(开始, 结束)
+# 开始条件不限制缩进，多合并几行只会让分块变大，不会影响渲染结果
+HTML_BLOCK_RES = (
+    (re.compile(r'^\s*<(?:pre|script|style|textarea)(?:\s|>|$)', re.I), re.compile(r'</(?:pre|script|style|textarea)>', re.I)),
+    (re.compile(r'^\s*<!--'), re.compile(r'-->')),
+    (re.compile(r'^\s*<\?'), re.compile(r'\?>')),
+    (re.compile(r'^\s*<!\[CDATA\['), re.compile(r'\]\]>')),
+    (re.compile(r'^\s*<![A-Za-z]'), re.compile(r'>')),
+)
+
 # 自定义UTC到北京时间转换函数（GMT+8） - 修改为直接返回时间
 def utc_to_beijing(utc_time):
     """简化的时间处理函数
@@ -132,8 +239,72 @@ def get_current_beijing_time():
 def get_db_connection():
     conn = sqlite3.connect('blog.db')
     conn.row_factory = sqlite3.Row
+    # 注册SQL函数，搜索时可以在SQL中读取压缩后的正文
+    conn.create_function('post_content', 2, decode_post_content, deterministic=True)
+    # 记录读取数据之前的片段缓存代数，渲染出的片段只有在代数未变化时才写入缓存，
+    # 避免在读取数据后、写入缓存前其他请求修改了文章，旧内容被当作新代数的片段保存
+    if has_request_context() and 'fragment_generation' not in g:
+        g.fragment_generation = fragment_cache.generation()
     return conn
 
+# 压缩文章正文
+def encode_post_content(content):
+    """按配置压缩文章正文
+    
+    Args:
+        content: Markdown正文
+        
+    Returns:
+        (保存到content列的值, 保存到content_encoding列的值)，未压缩时编码为None
+    """
+    raw = content.encode('utf-8')
+    if not app.config['CONTENT_COMPRESSION'] or len(raw) < app.config['CONTENT_COMPRESSION_THRESHOLD']:
+        return content, None
+    compressed = zlib.compress(raw, app.config['CONTENT_COMPRESSION_LEVEL'])
+    # 压缩效果不明显时保存原文，读取时可以省去解压
+    if len(compressed) > len(raw) * 0.9:
+        return content, None
+    return compressed, 'zlib'
+
+# 解压文章正文
+def decode_post_content(content, encoding):
+    if encoding == 'zlib':
+        return zlib.decompress(content).decode('utf-8')
+    return content
+
+# 读取文章正文，所有读取正文的地方都应通过此函数
+def get_post_content(post):
+    return decode_post_content(post['content'], post['content_encoding'])
+
+# 判断文章正文是否超过size字节，压缩的正文最多只解压size字节
+def post_content_exceeds(post, size):
+    if post['content_encoding'] != 'zlib':
+        return len(post['content'].encode('utf-8')) > size
+    decompressor = zlib.decompressobj()
+    decompressor.decompress(post['content'], size)
+    return not decompressor.eof
+
+# 逐行读取文章正文，压缩的正文边解压边读取，内存中不保留完整的解压结果
+def iter_post_content_lines(post, chunk_size=64 * 1024):
+    if post['content_encoding'] != 'zlib':
+        # 关闭压缩或压缩效果不明显时，未压缩的正文也可能很长，逐行读取而不是一次拆成列表
+        yield from io.StringIO(post['content'], newline='')
+        return
+    
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    data = post['content']
+    pending = ''
+    while data:
+        pending += decoder.decode(decompressor.decompress(data, chunk_size))
+        data = decompressor.unconsumed_tail
+        lines = io.StringIO(pending, newline='').readlines()
+        # 最后一行可能还没读完（包括\r\n被截断在\r处的情况），留到下一次
+        pending = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+        yield from lines
+    pending += decoder.decode(decompressor.flush(), final=True)
+    yield from io.StringIO(pending, newline='')
+
 # 初始化数据库
 def init_db():
     conn = get_db_connection()
@@ -180,6 +351,21 @@ def init_db():
         )
     ''')
     
+    # 为按标签查找文章添加索引（post_tags的主键只覆盖post_id开头的查询）
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_post_tags_tag ON post_tags (tag_id, post_id)')
+    
+    # 创建相关文章索引表，保存每篇文章预先计算好的前N篇相关文章
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS related_posts (
+            post_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            related_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (post_id, rank)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_related_posts_related ON related_posts (related_id)')
+    
     # 尝试为现有posts表添加author_id列（如果不存在）
     try:
         conn.execute('ALTER TABLE posts ADD COLUMN author_id INTEGER REFERENCES users (id)')
@@ -188,16 +374,697 @@ def init_db():
         # 如果列已存在，忽略错误
         pass
     
+    # 尝试为现有posts表添加正文编码列（NULL表示未压缩）
+    try:
+        conn.execute('ALTER TABLE posts ADD COLUMN content_encoding TEXT')
+        conn.commit()
+    except sqlite3.OperationalError:
+        pass
+    
+    # 创建文章历史版本表，data为完整快照或相对上一版本的差异
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS post_revisions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            is_snapshot INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL,
+            data_encoding TEXT,
+            author_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (post_id, revision)
+        )
+    ''')
+    
+    # 为按时间和按作者浏览添加索引
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_posts_created ON posts (created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_posts_author ON posts (author_id, created_at, id)')
+    
+    # 创建归档统计表，按作者和年月保存文章数量（author_id为0表示作者未知或已删除）
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_counts (
+            author_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            post_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (author_id, year, month)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_counts_month ON archive_counts (year, month)')
+    
+    # 首次升级时根据已有文章生成归档统计
+    if conn.execute('SELECT COUNT(*) FROM archive_counts').fetchone()[0] == 0:
+        rebuild_archive_counts(conn)
+    
+    conn.commit()
     conn.close()
 
+# 根据文章表重新生成归档统计
+def rebuild_archive_counts(conn):
+    """清空并重新统计每个作者每个月的文章数量，调用方负责提交事务"""
+    conn.execute('DELETE FROM archive_counts')
+    conn.execute('''
+        INSERT INTO archive_counts (author_id, year, month, post_count)
+        SELECT COALESCE(author_id, 0),
+               CAST(strftime('%Y', created_at) AS INTEGER),
+               CAST(strftime('%m', created_at) AS INTEGER),
+               COUNT(*)
+        FROM posts
+        WHERE strftime('%Y', created_at) IS NOT NULL
+        GROUP BY 1, 2, 3
+    ''')
+
+# 更新单个作者单个月份的文章数量
+def update_archive_count(conn, author_id, created_at, delta):
+    """在创建或删除文章时增减归档统计
+    
+    Args:
+        conn: 数据库连接（与写文章使用同一个事务）
+        author_id: 作者ID，可以为None
+        created_at: 文章创建时间
+        delta: 增减的数量
+    """
+    created = utc_to_beijing(created_at)
+    if not isinstance(created, datetime):
+        return
+    conn.execute('''
+        INSERT INTO archive_counts (author_id, year, month, post_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (author_id, year, month) DO UPDATE SET post_count = post_count + excluded.post_count
+    ''', (author_id or 0, created.year, created.month, delta))
+    conn.execute('DELETE FROM archive_counts WHERE author_id = ? AND year = ? AND month = ? AND post_count <= 0',
+                 (author_id or 0, created.year, created.month))
+
+# 获取按月归档列表（用于侧边栏）
+def get_archive_months(conn):
+    months = conn.execute('''
+        SELECT year, month, SUM(post_count) AS post_count
+        FROM archive_counts
+        GROUP BY year, month
+        HAVING SUM(post_count) > 0
+        ORDER BY year DESC, month DESC
+    ''').fetchall()
+    return [dict(month) for month in months]
+
+# 生成和解析分页游标，游标由文章的创建时间和ID组成
+def encode_cursor(post):
+    return f"{post['created_at']}|{post['id']}"
+
+def decode_cursor(cursor):
+    """解析分页游标，无效时返回None"""
+    created_at, _, post_id = (cursor or '').rpartition('|')
+    if not created_at or not post_id.isdigit():
+        return None
+    return created_at, int(post_id)
+
+# 文章列表查询的字段，不读取正文
+POST_LIST_COLUMNS = 'p.id, p.title, p.created_at, p.author_id, u.username'
+
+# 文章列表中的文章
+class PostPreview(dict):
+    """文章列表中单篇文章的显示数据
+    
+    正文只有在模板真正用到时（文章卡片未命中片段缓存）才从数据库读取并解压，
+    卡片命中缓存时列表页完全不读取正文。
+    """
+    
+    def __missing__(self, key):
+        if key != 'content':
+            raise KeyError(key)
+        conn = get_db_connection()
+        row = conn.execute('SELECT content, content_encoding FROM posts WHERE id = ?', (self['id'],)).fetchone()
+        conn.close()
+        self['content'] = get_post_content(row) if row else ''
+        return self['content']
+
+# 为文章列表中的单篇文章准备显示数据
+def prepare_post_preview(conn, post):
+    # Markdown在模板中渲染，文章卡片命中片段缓存时不需要读取正文，也不需要再渲染
+    post_dict = PostPreview(post)
+    post_dict['created_at'] = format_time(post['created_at'])
+    if 'author_id' not in post_dict:
+        post_dict['author_id'] = None
+    if 'username' not in post_dict:
+        post_dict['username'] = '未知用户'
+    
+    # 获取文章标签
+    post_tags = conn.execute('''
+        SELECT t.id, t.name FROM tags t
+        JOIN post_tags pt ON t.id = pt.tag_id
+        WHERE pt.post_id = ?
+    ''', (post_dict['id'],)).fetchall()
+    post_dict['tags'] = [dict(tag) for tag in post_tags]
+    return post_dict
+
+# 按固定大小分批，避免IN查询的参数数量超过SQLite的变量数上限
+def chunked(items, size=500):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# 计算各篇文章标签向量的长度
+def _vector_norms(post_tags, df, total):
+    """基于标签的TF-IDF权重计算每篇文章标签向量的长度，每次更新只计算一次"""
+    weights = {}
+    norms = {}
+    for post_id, tags in post_tags.items():
+        for tag_id in tags:
+            if tag_id not in weights:
+                weights[tag_id] = math.log((1 + total) / (1 + df.get(tag_id, 0))) + 1
+        norms[post_id] = math.sqrt(sum(weights[t] ** 2 for t in tags))
+    return norms
+
+# 计算单篇文章与其他文章的相似度
+def _related_scores(post_id, post_tags, postings, df, total, norms):
+    """基于标签的TF-IDF余弦相似度计算某篇文章与其他文章的得分
+    
+    标签向量是稀疏的，因此只沿着该文章各标签的倒排列表累加得分，
+    不需要与所有文章两两比较。
+    
+    Args:
+        post_id: 文章ID
+        post_tags: 文章ID到标签ID集合的映射
+        postings: 标签ID到文章ID列表的倒排索引
+        df: 标签ID到包含该标签的文章数的映射
+        total: 文章总数
+        norms: 文章ID到标签向量长度的映射
+        
+    Returns:
+        其他文章ID到得分的映射
+    """
+    tags = post_tags.get(post_id)
+    if not tags:
+        return {}
+    
+    scores = {}
+    for tag_id in tags:
+        w = (math.log((1 + total) / (1 + df.get(tag_id, 0))) + 1) ** 2
+        for other_id in postings.get(tag_id, ()):
+            if other_id != post_id:
+                scores[other_id] = scores.get(other_id, 0.0) + w
+    
+    own_norm = norms[post_id]
+    return {other_id: score / (own_norm * norms[other_id]) for other_id, score in scores.items()}
+
+# 取得分最高的前N篇相关文章
+def _top_related(scores, limit):
+    # 得分相同时优先较新的文章
+    return heapq.nlargest(limit, ((score, other_id) for other_id, score in scores.items()))
+
+# 保存单篇文章的相关文章列表
+def _store_related(conn, post_id, related):
+    conn.execute('DELETE FROM related_posts WHERE post_id = ?', (post_id,))
+    conn.executemany(
+        'INSERT INTO related_posts (post_id, rank, related_id, score) VALUES (?, ?, ?, ?)',
+        [(post_id, rank, other_id, score) for rank, (score, other_id) in enumerate(related)]
+    )
+
+# 增量更新相关文章索引
+def update_related_posts(conn, post_id):
+    """文章创建、修改标签或删除后增量更新相关文章索引
+    
+    只重新计算这篇文章自己的相关文章列表；对于共享标签的其他文章，
+    把与这篇文章的新得分合并到它们已保存的前N名中，只有这篇文章原来就在列表中
+    或新进入列表时才改写。标签权重变化对其他文章排名的影响，
+    以及删除文章后列表中空出的名额，在离线全量重建（flask rebuild-related）时修正。
+    调用方负责提交事务。
+    """
+    limit = app.config['RELATED_POSTS_LIMIT']
+    # 原来把这篇文章列为相关文章的文章
+    referrers = {row[0] for row in conn.execute(
+        'SELECT post_id FROM related_posts WHERE related_id = ?', (post_id,))}
+    
+    if conn.execute('SELECT 1 FROM posts WHERE id = ?', (post_id,)).fetchone() is None:
+        # 文章已被删除，清理它的索引并从其他文章的列表中移除
+        conn.execute('DELETE FROM related_posts WHERE post_id = ? OR related_id = ?', (post_id, post_id))
+        return
+    
+    total = conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+    own_tags = {row[0] for row in conn.execute('SELECT tag_id FROM post_tags WHERE post_id = ?', (post_id,))}
+    
+    # 共享这些标签的候选文章
+    postings = {}
+    for chunk in chunked(own_tags):
+        for tag_id, other_id in conn.execute(f'''
+                SELECT pt.tag_id, pt.post_id FROM post_tags pt
+                JOIN posts p ON p.id = pt.post_id
+                WHERE pt.tag_id IN ({','.join('?' * len(chunk))})''', chunk):
+            postings.setdefault(tag_id, []).append(other_id)
+    df = {tag_id: len(ids) for tag_id, ids in postings.items()}
+    
+    # 候选文章的完整标签集合（用于计算向量长度）
+    post_tags = {post_id: own_tags}
+    candidates = set().union(*postings.values()) - {post_id} if postings else set()
+    for chunk in chunked(candidates):
+        for other_id, tag_id in conn.execute(
+                f"SELECT post_id, tag_id FROM post_tags WHERE post_id IN ({','.join('?' * len(chunk))})", chunk):
+            post_tags.setdefault(other_id, set()).add(tag_id)
+    
+    other_tags = set().union(*post_tags.values()) - set(df)
+    for chunk in chunked(other_tags):
+        df.update(conn.execute(f'''
+            SELECT pt.tag_id, COUNT(*) FROM post_tags pt
+            JOIN posts p ON p.id = pt.post_id
+            WHERE pt.tag_id IN ({','.join('?' * len(chunk))})
+            GROUP BY pt.tag_id''', chunk).fetchall())
+    
+    norms = _vector_norms(post_tags, df, total)
+    scores = _related_scores(post_id, post_tags, postings, df, total, norms)
+    _store_related(conn, post_id, _top_related(scores, limit))
+    
+    # 把新得分合并到其他文章已保存的列表中
+    neighbours = set(scores) | referrers
+    stored = {}
+    for chunk in chunked(neighbours):
+        for other_id, related_id, score in conn.execute(
+                f"SELECT post_id, related_id, score FROM related_posts WHERE post_id IN ({','.join('?' * len(chunk))})",
+                chunk):
+            stored.setdefault(other_id, []).append((score, related_id))
+    for other_id in neighbours:
+        old = heapq.nlargest(limit, stored.get(other_id, []))
+        merged = [(score, related_id) for score, related_id in old if related_id != post_id]
+        if other_id in scores:
+            merged.append((scores[other_id], post_id))
+        merged = heapq.nlargest(limit, merged)
+        if merged != old:
+            _store_related(conn, other_id, merged)
+
+# 全量重建相关文章索引
+def rebuild_related_posts(conn):
+    """一次性读取全部文章标签并重建相关文章索引，适用于大量历史文章的离线重建
+    
+    Returns:
+        重建的文章数量
+    """
+    limit = app.config['RELATED_POSTS_LIMIT']
+    post_tags = {}
+    postings = {}
+    for post_id, tag_id in conn.execute('''
+            SELECT pt.post_id, pt.tag_id FROM post_tags pt
+            JOIN posts p ON p.id = pt.post_id'''):
+        post_tags.setdefault(post_id, set()).add(tag_id)
+        postings.setdefault(tag_id, []).append(post_id)
+    df = {tag_id: len(ids) for tag_id, ids in postings.items()}
+    total = conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+    norms = _vector_norms(post_tags, df, total)
+    
+    conn.execute('DELETE FROM related_posts')
+    for post_id in post_tags:
+        scores = _related_scores(post_id, post_tags, postings, df, total, norms)
+        _store_related(conn, post_id, _top_related(scores, limit))
+    conn.commit()
+    return len(post_tags)
+
+# 读取文章的相关文章（请求路径上只做一次索引查询）
+def get_related_posts(conn, post_id):
+    related = conn.execute('''
+        SELECT p.id, p.title FROM related_posts r
+        JOIN posts p ON p.id = r.related_id
+        WHERE r.post_id = ?
+        ORDER BY r.rank
+    ''', (post_id,)).fetchall()
+    return [dict(row) for row in related]
+
+# 检查当前请求是否来自管理员
+def is_admin():
+    if session.get('username') in app.config['ADMIN_USERNAMES']:
+        return True
+    token = app.config['ADMIN_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+# 管理员认证装饰器
+def admin_required(f):
+    def decorated_function(*args, **kwargs):
+        if not is_admin():
+            abort(403)
+        return f(*args, **kwargs)
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+# 限流装饰器
+def rate_limited(rules):
+    """对高开销的路由做准入控制，超过限制的请求直接返回429/503
+    
+    Args:
+        rules: 根据当前请求返回适用规则名列表的函数
+    """
+    def decorator(f):
+        def decorated_function(*args, **kwargs):
+            applied = rules()
+            if not applied:
+                return f(*args, **kwargs)
+            
+            # 按客户端IP和用户分别限流；登录和注册按提交的用户名限流，防止撞库
+            keys = [f'ip:{request.remote_addr}']
+            if 'user_id' in session:
+                keys.append(f'user:{session["user_id"]}')
+            elif request.form.get('username'):
+                keys.append(f'name:{request.form["username"]}')
+            
+            decision = rate_limiter.admit(applied, keys)
+            if decision.status == 429:
+                response = make_response('请求过于频繁，请稍后再试', 429)
+            elif decision.status == 503:
+                response = make_response('服务器繁忙，请稍后再试', 503)
+            else:
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    rate_limiter.release(decision)
+            
+            logger.warning(f'请求被限流：{request.remote_addr} {request.path} 规则 {applied}')
+            response.headers['Retry-After'] = str(decision.retry_after)
+            return response
+        decorated_function.__name__ = f.__name__
+        return decorated_function
+    return decorator
+
+# 生成两个版本正文之间的差异
+def make_content_delta(old, new):
+    """按行比较两个版本的正文，生成紧凑的差异（JSON）
+    
+    差异是一个操作列表：[起始行, 结束行]表示复制上一版本中的这些行，
+    字符串列表表示插入新的行，未提到的旧行即为删除。
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(new_lines[j1:j2])
+    return json.dumps(ops, ensure_ascii=False, separators=(',', ':'))
+
+# 将差异应用到上一版本的正文上
+def apply_content_delta(old, delta):
+    old_lines = old.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(delta):
+        if op and isinstance(op[0], int):
+            parts.extend(old_lines[op[0]:op[1]])
+        else:
+            parts.extend(op)
+    return ''.join(parts)
+
+# 开始修改文章的写事务，并在事务内重新读取文章
+def begin_post_update(conn, post_id):
+    """立即获取写锁后重新读取文章，作为记录历史版本的基准
+    
+    打开编辑页面后读取的文章可能已被同时提交的另一次保存修改，
+    如果用旧记录计算差异，新版本会叠加在错误的基准上。
+    
+    Returns:
+        事务内读取的文章记录
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    post = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+    if post is None:
+        raise ValueError('文章不存在')
+    return post
+
+# 保存一个新的历史版本
+def record_revision(conn, post, title, content, user_id):
+    """在编辑文章的事务中记录新版本，调用方负责提交事务
+    
+    每个版本保存为相对上一版本的差异，每隔REVISION_SNAPSHOT_INTERVAL个版本
+    保存一次完整快照，这样还原任意版本最多只需要应用有限个差异。
+    
+    Args:
+        conn: 数据库连接
+        post: 修改前的文章记录，必须在同一事务中读取（见begin_post_update）
+        title: 新标题
+        content: 新正文
+        user_id: 修改者ID
+    """
+    old_content = get_post_content(post)
+    if title == post['title'] and content == old_content:
+        return
+    
+    current_time = get_current_beijing_time().strftime('%Y-%m-%d %H:%M:%S')
+    latest = conn.execute('''
+        SELECT MAX(revision), MAX(CASE WHEN is_snapshot THEN revision END)
+        FROM post_revisions WHERE post_id = ?
+    ''', (post['id'],)).fetchone()
+    revision, last_snapshot = latest[0] or 0, latest[1] or 0
+    
+    # 第一次编辑时先把原始版本保存为快照
+    if revision == 0:
+        data, data_encoding = encode_post_content(old_content)
+        conn.execute('''
+            INSERT INTO post_revisions (post_id, revision, title, is_snapshot, data, data_encoding, author_id, created_at)
+            VALUES (?, 1, ?, 1, ?, ?, ?, ?)
+        ''', (post['id'], post['title'], data, data_encoding, post['author_id'], post['created_at']))
+        revision = last_snapshot = 1
+    
+    revision += 1
+    delta = make_content_delta(old_content, content)
+    if revision - last_snapshot >= app.config['REVISION_SNAPSHOT_INTERVAL'] or len(delta) >= len(content):
+        data, data_encoding = encode_post_content(content)
+        is_snapshot = 1
+    else:
+        data, data_encoding = delta, None
+        is_snapshot = 0
+    conn.execute('''
+        INSERT INTO post_revisions (post_id, revision, title, is_snapshot, data, data_encoding, author_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (post['id'], revision, title, is_snapshot, data, data_encoding, user_id, current_time))
+    
+    # 清理超出保留数量的旧版本：只能删除到某个快照之前，保证剩余版本都能还原
+    cutoff = revision - app.config['REVISION_KEEP'] + 1
+    if cutoff > 1:
+        base = conn.execute('''
+            SELECT MAX(revision) FROM post_revisions
+            WHERE post_id = ? AND is_snapshot = 1 AND revision <= ?
+        ''', (post['id'], cutoff)).fetchone()[0]
+        if base:
+            conn.execute('DELETE FROM post_revisions WHERE post_id = ? AND revision < ?', (post['id'], base))
+
+# 还原指定的历史版本
+def get_revision(conn, post_id, revision):
+    """从最近的快照开始依次应用差异，还原指定版本
+    
+    Returns:
+        包含revision、title、content、created_at、username的字典，版本不存在时返回None
+    """
+    rows = conn.execute('''
+        SELECT r.*, u.username FROM post_revisions r
+        LEFT JOIN users u ON r.author_id = u.id
+        WHERE r.post_id = ? AND r.revision <= ? AND r.revision >= (
+            SELECT MAX(revision) FROM post_revisions
+            WHERE post_id = ? AND is_snapshot = 1 AND revision <= ?
+        )
+        ORDER BY r.revision
+    ''', (post_id, revision, post_id, revision)).fetchall()
+    if not rows or rows[-1]['revision'] != revision:
+        return None
+    
+    content = None
+    for row in rows:
+        if row['is_snapshot']:
+            content = decode_post_content(row['data'], row['data_encoding'])
+        else:
+            content = apply_content_delta(content, row['data'])
+    last = rows[-1]
+    return {
+        'revision': revision,
+        'title': last['title'],
+        'content': content,
+        'created_at': format_time(last['created_at']),
+        'username': last['username'],
+    }
+
+# 将Markdown拆分为可以独立渲染的块
+def split_markdown_blocks(content):
+    """按空行把Markdown拆分成块，逐块生成
+    
+    只在不会影响渲染结果的空行处拆分：围栏代码块和可以包含空行的HTML块（<pre>、
+    注释等）在结束之前不拆分；空行后的缩进行（列表项的后续内容或缩进代码）不拆分；
+    块中已经出现列表项时，空行后的列表项属于同一个列表，也不拆分。
+    content可以是字符串，也可以是逐行生成的可迭代对象。
+    """
+    lines = io.StringIO(content, newline='') if isinstance(content, str) else content
+    block = []
+    fence = None
+    html_end = None
+    in_list = False
+    after_blank = False
+    for line in lines:
+        if fence:
+            block.append(line)
+            if fence.match(line):
+                fence = None
+            continue
+        if html_end:
+            block.append(line)
+            if html_end.search(line):
+                html_end = None
+            continue
+        
+        if not line.strip():
+            if block:
+                after_blank = True
+                block.append(line)
+            continue
+        
+        if after_blank:
+            continuation = line[0] in ' \t' or (in_list and LIST_ITEM_RE.match(line))
+            if not continuation:
+                yield ''.join(block)
+                block = []
+                in_list = False
+            after_blank = False
+        
+        match = FENCE_RE.match(line)
+        if match:
+            marker = match.group(1)
+            fence = re.compile(r'^ {0,3}' + re.escape(marker[0]) + '{' + str(len(marker)) + r',}\s*$')
+        else:
+            for start_re, end_re in HTML_BLOCK_RES:
+                match = start_re.match(line)
+                if match:
+                    # 结束标记可能与开始标记在同一行
+                    if not end_re.search(line, match.end()):
+                        html_end = end_re
+                    break
+            if LIST_ITEM_RE.match(line):
+                in_list = True
+        block.append(line)
+    
+    if block:
+        yield ''.join(block)
+
+# 渲染Markdown预览
+def render_preview_blocks(content, known=()):
+    """逐块渲染Markdown，已渲染过的块直接从缓存读取
+    
+    Args:
+        content: Markdown内容
+        known: 客户端已经有渲染结果的块哈希，这些块不再返回HTML
+        
+    Returns:
+        [{'hash': 块哈希, 'html': 渲染结果}]，已知的块只包含hash
+    """
+    # 链接引用定义会影响其他块的渲染，这种情况下整篇作为一个块渲染
+    blocks = [content] if REFERENCE_RE.search(content) else split_markdown_blocks(content)
+    known = set(known)
+    result = []
+    for block in blocks:
+        block_hash = hashlib.sha1(block.encode('utf-8')).hexdigest()
+        if block_hash in known:
+            result.append({'hash': block_hash})
+        else:
+            result.append({'hash': block_hash, 'html': preview_cache.get_or_render(block_hash, lambda: md.render(block))})
+    return result
+
+# 文章正文HTML在片段缓存中的键，文章页（包括流式输出）和JSON接口共用
+def post_html_cache_key(post_id):
+    return f'post-html:[{post_id}]'
+
+# 逐块渲染文章正文，用于文章页的流式输出
+def stream_post_body(post, chunk_size=64 * 1024):
+    """分段生成文章正文的HTML
+    
+    先读取片段缓存，命中时把缓存的HTML分段发送，不需要解压和渲染正文。
+    未命中时逐块渲染：链接引用定义可以出现在文章的任何位置，因此先扫描一遍
+    正文收集所有定义，再逐块渲染并发送。渲染完成后把完整的HTML写入片段缓存
+    （超过缓存大小上限时不写入），下一次访问直接使用。渲染结果不写入预览缓存。
+    """
+    use_cache = app.config['FRAGMENT_CACHE_ENABLED']
+    key = post_html_cache_key(post['id'])
+    if use_cache:
+        html = fragment_cache.get(key)
+        if html is not None:
+            for start in range(0, len(html), chunk_size):
+                yield html[start:start + chunk_size]
+            return
+    
+    env = {}
+    for block in split_markdown_blocks(iter_post_content_lines(post)):
+        if REFERENCE_RE.search(block):
+            md.parse(block, env)
+    
+    # 缓存的是完整的HTML，只有能写入缓存时才保留已发送的块
+    parts = [] if use_cache else None
+    size = 0
+    for block in split_markdown_blocks(iter_post_content_lines(post)):
+        html = md.render(block, env)
+        if parts is not None:
+            parts.append(html)
+            size += len(html)
+            if size > fragment_cache.max_bytes:
+                parts = None
+        yield html
+    
+    if parts is not None:
+        try:
+            fragment_cache.set(key, ''.join(parts), g.get('fragment_generation'))
+        except sqlite3.OperationalError as e:
+            logger.warning(f'写入片段缓存失败: {e}')
+
+# 读取首页的标签筛选参数：tag（全部包含）、any_tag（包含任一）、not_tag（不包含）
+def get_tag_filters():
+    filters = {'search': request.args.get('search', '')}
+    for name in ('tag', 'any_tag', 'not_tag'):
+        values = []
+        for value in request.args.getlist(name):
+            value = value.strip()
+            if value and value not in values:
+                values.append(value)
+        filters[name] = values[:10]
+    return filters
+
+# 生成修改了部分筛选条件的首页链接，空条件不出现在链接中
+@app.template_global()
+def tag_filter_url(filters, **changes):
+    args = dict(filters, **changes)
+    return url_for('index', **{name: value for name, value in args.items() if value})
+
+# 使用标签倒排索引筛选文章，返回按创建时间倒序排列的文章ID列表
+def query_tagged_post_ids(conn, filters, search_query='', before=None):
+    tag_index.ensure_fresh(conn, fragment_cache.generation())
+    post_ids = tag_index.query(filters['tag'], filters['any_tag'], filters['not_tag'], before)
+    if search_query and post_ids:
+        # 同时有搜索关键词时，只在标签筛选结果中匹配
+        matched = {row[0] for row in conn.execute('''
+            SELECT id FROM posts
+            WHERE title LIKE ? OR post_content(content, content_encoding) LIKE ?
+        ''', (f'%{search_query}%', f'%{search_query}%'))}
+        post_ids = [post_id for post_id in post_ids if post_id in matched]
+    return post_ids
+
+# 按给定顺序读取一组文章
+def fetch_posts_by_ids(conn, post_ids, columns=POST_LIST_COLUMNS):
+    if not post_ids:
+        return []
+    id_list = ','.join('?' * len(post_ids))
+    rows = conn.execute(f'''
+        SELECT {columns}
+        FROM posts p
+        LEFT JOIN users u ON p.author_id = u.id
+        WHERE p.id IN ({id_list})
+    ''', tuple(post_ids)).fetchall()
+    by_id = {row['id']: row for row in rows}
+    return [by_id[post_id] for post_id in post_ids if post_id in by_id]
+
+# 首页适用的限流规则：搜索和深度分页
+def index_rate_rules():
+    rules = []
+    if request.args.get('search'):
+        rules.append('search')
+    if request.args.get('page', 1, type=int) > app.config['DEEP_PAGE_THRESHOLD']:
+        rules.append('deep_page')
+    return rules
+
 # 首页路由，显示所有博客文章，添加分页功能
 @app.route('/')
+@rate_limited(index_rate_rules)
 def index():
     conn = get_db_connection()
     
     # 获取搜索关键词和标签
     search_query = request.args.get('search', '')
-    tag_filter = request.args.get('tag', '')
+    tag_filters = get_tag_filters()
     
     # 获取页码，默认为第1页
     page = request.args.get('page', 1, type=int)
@@ -209,35 +1076,18 @@ def index():
     all_tags = [dict(tag) for tag in tags]
     
     # 构建查询，添加分页参数
-    if search_query and tag_filter:
-        # 同时有搜索关键词和标签筛选
-        posts = conn.execute('''
-            SELECT DISTINCT p.*, u.username 
-            FROM posts p 
-            LEFT JOIN users u ON p.author_id = u.id
-            JOIN post_tags pt ON p.id = pt.post_id
-            JOIN tags t ON pt.tag_id = t.id
-            WHERE (p.title LIKE ? OR p.content LIKE ?) AND t.name = ?
-            ORDER BY p.created_at DESC
-            LIMIT ? OFFSET ?
-        ''', (f'%{search_query}%', f'%{search_query}%', tag_filter, per_page, offset)).fetchall()
-        
-        # 获取总记录数
-        total = conn.execute('''
-            SELECT COUNT(DISTINCT p.id) 
-            FROM posts p 
-            LEFT JOIN users u ON p.author_id = u.id
-            JOIN post_tags pt ON p.id = pt.post_id
-            JOIN tags t ON pt.tag_id = t.id
-            WHERE (p.title LIKE ? OR p.content LIKE ?) AND t.name = ?
-        ''', (f'%{search_query}%', f'%{search_query}%', tag_filter)).fetchone()[0]
+    if tag_filters['tag'] or tag_filters['any_tag'] or tag_filters['not_tag']:
+        # 标签筛选在内存倒排索引中完成，只按页读取需要显示的文章
+        post_ids = query_tagged_post_ids(conn, tag_filters, search_query)
+        total = len(post_ids)
+        posts = fetch_posts_by_ids(conn, post_ids[offset:offset + per_page])
     elif search_query:
         # 只有搜索关键词
-        posts = conn.execute('''
-            SELECT p.*, u.username 
+        posts = conn.execute(f'''
+            SELECT {POST_LIST_COLUMNS}
             FROM posts p 
             LEFT JOIN users u ON p.author_id = u.id 
-            WHERE p.title LIKE ? OR p.content LIKE ?
+            WHERE p.title LIKE ? OR post_content(p.content, p.content_encoding) LIKE ?
             ORDER BY p.created_at DESC
             LIMIT ? OFFSET ?
         ''', (f'%{search_query}%', f'%{search_query}%', per_page, offset)).fetchall()
@@ -246,32 +1096,12 @@ def index():
             SELECT COUNT(*) 
             FROM posts p 
             LEFT JOIN users u ON p.author_id = u.id 
-            WHERE p.title LIKE ? OR p.content LIKE ?
+            WHERE p.title LIKE ? OR post_content(p.content, p.content_encoding) LIKE ?
         ''', (f'%{search_query}%', f'%{search_query}%')).fetchone()[0]
-    elif tag_filter:
-        # 只有标签筛选
-        posts = conn.execute('''
-            SELECT DISTINCT p.*, u.username 
-            FROM posts p 
-            LEFT JOIN users u ON p.author_id = u.id
-            JOIN post_tags pt ON p.id = pt.post_id
-            JOIN tags t ON pt.tag_id = t.id
-            WHERE t.name = ?
-            ORDER BY p.created_at DESC
-            LIMIT ? OFFSET ?
-        ''', (tag_filter, per_page, offset)).fetchall()
-        
-        total = conn.execute('''
-            SELECT COUNT(DISTINCT p.id) 
-            FROM posts p 
-            JOIN post_tags pt ON p.id = pt.post_id
-            JOIN tags t ON pt.tag_id = t.id
-            WHERE t.name = ?
-        ''', (tag_filter,)).fetchone()[0]
     else:
         # 没有搜索条件
-        posts = conn.execute('''
-            SELECT p.*, u.username 
+        posts = conn.execute(f'''
+            SELECT {POST_LIST_COLUMNS}
             FROM posts p 
             LEFT JOIN users u ON p.author_id = u.id 
             ORDER BY p.created_at DESC
@@ -281,40 +1111,117 @@ def index():
         total = conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
     
     # 为每个文章获取标签
-    posts_with_tags = []
-    for post in posts:
-        post_dict = dict(post)
-        post_dict['content_html'] = md.render(post['content'])
-        post_dict['created_at'] = format_time(post['created_at'])
-        if 'author_id' not in post_dict:
-            post_dict['author_id'] = None
-        if 'username' not in post_dict:
-            post_dict['username'] = '未知用户'
-        
-        # 获取文章标签
-        post_tags = conn.execute('''
-            SELECT t.id, t.name FROM tags t
-            JOIN post_tags pt ON t.id = pt.tag_id
-            WHERE pt.post_id = ?
-        ''', (post_dict['id'],)).fetchall()
-        post_dict['tags'] = [dict(tag) for tag in post_tags]
-        
-        posts_with_tags.append(post_dict)
+    posts_with_tags = [prepare_post_preview(conn, post) for post in posts]
     
     # 计算总页数
     total_pages = (total + per_page - 1) // per_page
     
+    # 获取按月归档列表
+    archive_months = get_archive_months(conn)
+    
     conn.close()
     
     return render_template('index.html', 
                            posts=posts_with_tags, 
                            all_tags=all_tags,
                            search_query=search_query, 
-                           selected_tag=tag_filter,
+                           tag_filters=tag_filters,
                            page=page,
                            total_pages=total_pages,
                            per_page=per_page,
-                           total=total)
+                           total=total,
+                           archive_months=archive_months)
+
+# 按条件分页查询文章（基于游标，不使用OFFSET）
+def query_post_page(conn, where, params, cursor, per_page, columns=POST_LIST_COLUMNS):
+    """按创建时间倒序查询一页文章
+    
+    Args:
+        conn: 数据库连接
+        where: 额外的WHERE条件
+        params: WHERE条件的参数
+        cursor: 上一页最后一篇文章的游标
+        per_page: 每页文章数量
+        columns: 查询的列，必须包含p.id和p.created_at
+        
+    Returns:
+        (文章记录列表, 下一页游标)，没有下一页时游标为None
+    """
+    position = decode_cursor(cursor)
+    if position:
+        where += ' AND (p.created_at, p.id) < (?, ?)'
+        params = tuple(params) + position
+    posts = conn.execute(f'''
+        SELECT {columns}
+        FROM posts p
+        LEFT JOIN users u ON p.author_id = u.id
+        WHERE {where}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    ''', tuple(params) + (per_page + 1,)).fetchall()
+    
+    next_cursor = encode_cursor(posts[per_page - 1]) if len(posts) > per_page else None
+    return posts[:per_page], next_cursor
+
+# 查询作者页和归档页的一页文章
+def query_archive_posts(conn, where, params, cursor):
+    posts, next_cursor = query_post_page(conn, where, params, cursor, app.config['ARCHIVE_PER_PAGE'])
+    return [prepare_post_preview(conn, post) for post in posts], next_cursor
+
+# 作者文章列表路由
+@app.route('/author/<int:author_id>')
+def author_posts(author_id):
+    conn = get_db_connection()
+    author = conn.execute('SELECT id, username FROM users WHERE id = ?', (author_id,)).fetchone()
+    if author is None:
+        conn.close()
+        flash('作者不存在')
+        return redirect(url_for('index'))
+    
+    cursor = request.args.get('cursor', '')
+    posts, next_cursor = query_archive_posts(conn, 'p.author_id = ?', (author_id,), cursor)
+    total = conn.execute('SELECT COALESCE(SUM(post_count), 0) FROM archive_counts WHERE author_id = ?',
+                         (author_id,)).fetchone()[0]
+    archive_months = get_archive_months(conn)
+    conn.close()
+    
+    return render_template('archive.html',
+                           heading=f'作者：{author["username"]}',
+                           posts=posts,
+                           total=total,
+                           cursor=cursor,
+                           next_url=next_cursor and url_for('author_posts', author_id=author_id, cursor=next_cursor),
+                           first_url=url_for('author_posts', author_id=author_id),
+                           archive_months=archive_months)
+
+# 按月归档文章列表路由
+@app.route('/archive/<int:year>/<int:month>')
+def archive(year, month):
+    if not 1 <= month <= 12:
+        flash('无效的归档月份')
+        return redirect(url_for('index'))
+    
+    # 使用[当月1日, 下月1日)的时间范围，可以直接利用created_at索引
+    start = f'{year:04d}-{month:02d}-01'
+    end = f'{year + 1:04d}-01-01' if month == 12 else f'{year:04d}-{month + 1:02d}-01'
+    
+    conn = get_db_connection()
+    cursor = request.args.get('cursor', '')
+    posts, next_cursor = query_archive_posts(conn, 'p.created_at >= ? AND p.created_at < ?', (start, end), cursor)
+    total = conn.execute('SELECT COALESCE(SUM(post_count), 0) FROM archive_counts WHERE year = ? AND month = ?',
+                         (year, month)).fetchone()[0]
+    archive_months = get_archive_months(conn)
+    conn.close()
+    
+    return render_template('archive.html',
+                           heading=f'{year}年{month:02d}月 归档',
+                           posts=posts,
+                           total=total,
+                           cursor=cursor,
+                           next_url=next_cursor and url_for('archive', year=year, month=month, cursor=next_cursor),
+                           first_url=url_for('archive', year=year, month=month),
+                           archive_months=archive_months,
+                           selected_month=(year, month))
 
 # 查看单个博客文章路由
 @app.route('/post/<int:post_id>')
@@ -336,9 +1243,14 @@ def post(post_id):
         flash('文章不存在')
         return redirect(url_for('index'))
     
-    # 渲染Markdown内容为HTML
+    # 较长的文章使用流式输出，否则Markdown内容在模板中渲染为HTML（可命中片段缓存）
+    stream = request.args.get('stream', type=int)
+    if stream is None:
+        stream = post_content_exceeds(post, app.config['POST_STREAM_MIN_SIZE'])
     post_dict = dict(post)
-    post_dict['content_html'] = md.render(post['content'])
+    # 正文只在文章正文未命中片段缓存时才解压
+    post_dict['content'] = None
+    post_dict['load_content'] = lambda: get_post_content(post)
     # 转换创建时间到北京时间
     post_dict['created_at'] = format_time(post['created_at'])
     # 确保字典中包含author_id和username键
@@ -357,8 +1269,19 @@ def post(post_id):
     ''', (post_id,)).fetchall()
     post_dict['tags'] = [dict(tag) for tag in post_tags]
     
+    # 从预先计算的索引中读取相关文章
+    related_posts = get_related_posts(conn, post_id)
+    
     conn.close()
-    return render_template('post.html', post=post_dict)
+    if stream:
+        # 页头、标题和标签立即发送，正文从片段缓存分段发送，或逐块渲染并发送
+        return stream_template('post.html', post=post_dict, related_posts=related_posts,
+                               body_blocks=stream_post_body(post))
+    return render_template('post.html', post=post_dict, related_posts=related_posts)
+
+
+# 初始化请求性能分析器（只允许管理员通过请求头触发）
+profiler = RequestProfiler(app, authorize=lambda: is_admin())
 
 # 用户认证装饰器
 def login_required(f):
@@ -372,6 +1295,7 @@ def login_required(f):
 
 # 用户注册路由
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limited(lambda: ['register'] if request.method == 'POST' else [])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -418,6 +1342,7 @@ def register():
 
 # 用户登录路由
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limited(lambda: ['login'] if request.method == 'POST' else [])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -473,11 +1398,13 @@ def create():
         conn.execute('BEGIN TRANSACTION')
         try:
             # 插入文章
-            cursor = conn.execute('INSERT INTO posts (title, content, created_at, author_id) VALUES (?, ?, ?, ?)', 
-                               (title, content, current_time, session['user_id']))
+            stored_content, content_encoding = encode_post_content(content)
+            cursor = conn.execute('INSERT INTO posts (title, content, content_encoding, created_at, author_id) VALUES (?, ?, ?, ?, ?)', 
+                               (title, stored_content, content_encoding, current_time, session['user_id']))
             post_id = cursor.lastrowid
             
             # 处理标签
+            tag_names = []
             if tags_input:
                 # 分割标签（支持逗号、空格或换行分割）
                 tag_names = [tag.strip() for tag in re.split(r'[\s,]+', tags_input) if tag.strip()]
@@ -495,8 +1422,15 @@ def create():
                     # 建立文章和标签的关联
                     conn.execute('INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)', (post_id, tag_id))
             
+            # 增量更新相关文章索引
+            update_related_posts(conn, post_id)
+            
+            # 更新归档统计
+            update_archive_count(conn, session['user_id'], current_time, 1)
+            
             # 在成功提交事务后添加日志
             conn.commit()
+            tag_index.update_post(post_id, current_time, tag_names, fragment_cache.invalidate())
             logger.info(f'用户 {session["user_id"]} 创建了新文章 {post_id}，标题：{title}')
             flash('文章创建成功')
             
@@ -547,17 +1481,20 @@ def edit(post_id):
             conn.close()
             return redirect(url_for('edit', post_id=post_id))
         
-        # 开始事务
-        conn.execute('BEGIN TRANSACTION')
         try:
-            # 更新文章
-            conn.execute('UPDATE posts SET title = ?, content = ? WHERE id = ?', (title, content, post_id))
+            # 开始事务，基于事务内读取的当前内容保存历史版本并更新文章
+            post = begin_post_update(conn, post_id)
+            record_revision(conn, post, title, content, session['user_id'])
+            stored_content, content_encoding = encode_post_content(content)
+            conn.execute('UPDATE posts SET title = ?, content = ?, content_encoding = ? WHERE id = ?',
+                         (title, stored_content, content_encoding, post_id))
             logger.info(f'用户 {session["user_id"]} 更新了文章 {post_id}，新标题：{title}')
             
             # 删除旧的标签关联
             conn.execute('DELETE FROM post_tags WHERE post_id = ?', (post_id,))
             
             # 处理新标签
+            tag_names = []
             if tags_input:
                 # 分割标签（支持逗号、空格或换行分割）
                 tag_names = [tag.strip() for tag in re.split(r'[\s,]+', tags_input) if tag.strip()]
@@ -575,7 +1512,11 @@ def edit(post_id):
                     # 建立文章和标签的关联
                     conn.execute('INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)', (post_id, tag_id))
             
+            # 增量更新相关文章索引
+            update_related_posts(conn, post_id)
+            
             conn.commit()
+            tag_index.update_post(post_id, post['created_at'], tag_names, fragment_cache.invalidate())
             flash('文章更新成功')
         except Exception as e:
             conn.rollback()
@@ -587,11 +1528,241 @@ def edit(post_id):
     
     # 将文章转换为字典并添加标签信息
     post_dict = dict(post)
+    post_dict['content'] = get_post_content(post)
     post_dict['existing_tags'] = existing_tags
     
     conn.close()
     return render_template('edit.html', post=post_dict)
 
+# 文章历史版本列表路由
+@app.route('/post/<int:post_id>/revisions')
+@login_required
+def revisions(post_id):
+    conn = get_db_connection()
+    post = conn.execute('SELECT id, title, author_id FROM posts WHERE id = ?', (post_id,)).fetchone()
+    
+    if post is None:
+        conn.close()
+        flash('文章不存在')
+        return redirect(url_for('index'))
+    
+    # 检查是否为文章作者
+    if post['author_id'] != session['user_id']:
+        conn.close()
+        flash('无权查看此文章的历史版本')
+        return redirect(url_for('post', post_id=post_id))
+    
+    revision_list = conn.execute('''
+        SELECT r.revision, r.title, r.is_snapshot, length(r.data) AS size, r.created_at, u.username
+        FROM post_revisions r
+        LEFT JOIN users u ON r.author_id = u.id
+        WHERE r.post_id = ?
+        ORDER BY r.revision DESC
+    ''', (post_id,)).fetchall()
+    revision_list = [dict(r, created_at=format_time(r['created_at'])) for r in revision_list]
+    
+    conn.close()
+    return render_template('revisions.html', post=dict(post), revisions=revision_list)
+
+# 查看和恢复单个历史版本路由
+@app.route('/post/<int:post_id>/revisions/<int:revision>', methods=['GET', 'POST'])
+@login_required
+def revision(post_id, revision):
+    conn = get_db_connection()
+    post = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+    
+    if post is None:
+        conn.close()
+        flash('文章不存在')
+        return redirect(url_for('index'))
+    
+    # 检查是否为文章作者
+    if post['author_id'] != session['user_id']:
+        conn.close()
+        flash('无权查看此文章的历史版本')
+        return redirect(url_for('post', post_id=post_id))
+    
+    old_revision = get_revision(conn, post_id, revision)
+    if old_revision is None:
+        conn.close()
+        flash('历史版本不存在')
+        return redirect(url_for('revisions', post_id=post_id))
+    
+    if request.method == 'POST':
+        # 恢复旧版本相当于一次新的编辑，同样会记录为新版本
+        try:
+            post = begin_post_update(conn, post_id)
+            record_revision(conn, post, old_revision['title'], old_revision['content'], session['user_id'])
+            stored_content, content_encoding = encode_post_content(old_revision['content'])
+            conn.execute('UPDATE posts SET title = ?, content = ?, content_encoding = ? WHERE id = ?',
+                         (old_revision['title'], stored_content, content_encoding, post_id))
+            conn.commit()
+            tag_index.advance(fragment_cache.invalidate())
+            logger.info(f'用户 {session["user_id"]} 将文章 {post_id} 恢复到版本 {revision}')
+            flash(f'已恢复到版本 {revision}')
+        except Exception as e:
+            conn.rollback()
+            flash('恢复版本失败: ' + str(e))
+        finally:
+            conn.close()
+        
+        return redirect(url_for('post', post_id=post_id))
+    
+    conn.close()
+    return render_template('revision.html', post=dict(post), revision=old_revision)
+
+# Markdown实时预览接口
+@app.route('/api/preview', methods=['POST'])
+@login_required
+def preview():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求格式错误'}), 400
+    content = data.get('content')
+    if not isinstance(content, str):
+        return jsonify({'error': '缺少预览内容'}), 400
+    if len(content) > app.config['PREVIEW_MAX_LENGTH']:
+        return jsonify({'error': f'内容超过{app.config["PREVIEW_MAX_LENGTH"]}个字符，无法预览'}), 413
+    
+    # 只接受字符串形式的块哈希，其他类型的元素直接忽略
+    known = data.get('known')
+    if not isinstance(known, list):
+        known = []
+    known = [block_hash for block_hash in known[:5000] if isinstance(block_hash, str)]
+    return jsonify({'blocks': render_preview_blocks(content, known)})
+
+# JSON接口允许选择的字段
+API_POST_FIELDS = ('id', 'title', 'created_at', 'author_id', 'username', 'tags', 'content', 'html')
+API_DEFAULT_LIST_FIELDS = ('id', 'title', 'created_at', 'author_id', 'username', 'tags')
+
+# 解析fields参数
+def parse_api_fields(default):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(default)
+    selected = [field.strip() for field in fields.split(',') if field.strip() in API_POST_FIELDS]
+    return selected or list(default)
+
+# 获取文章正文渲染后的HTML（使用片段缓存），文章页和JSON接口共用同一份缓存
+# load_content是返回Markdown正文的函数，只在未命中缓存时调用，命中时不需要解压正文
+@app.template_global()
+def get_post_html(post_id, load_content):
+    if not app.config['FRAGMENT_CACHE_ENABLED']:
+        return md.render(load_content())
+    return fragment_cache.get_or_render(post_html_cache_key(post_id), lambda: md.render(load_content()),
+                                        g.get('fragment_generation'))
+
+# 将文章记录转换为JSON接口返回的字典
+def serialize_api_posts(conn, posts, fields):
+    tags = {}
+    if 'tags' in fields and posts:
+        # 一次查询取出本页所有文章的标签
+        id_list = ','.join('?' * len(posts))
+        for row in conn.execute(f'''
+                SELECT pt.post_id, t.name FROM post_tags pt
+                JOIN tags t ON t.id = pt.tag_id
+                WHERE pt.post_id IN ({id_list})''', tuple(post['id'] for post in posts)):
+            tags.setdefault(row['post_id'], []).append(row['name'])
+    
+    result = []
+    for post in posts:
+        item = {}
+        for field in fields:
+            if field == 'tags':
+                item['tags'] = tags.get(post['id'], [])
+            elif field == 'created_at':
+                item['created_at'] = format_time(post['created_at'])
+            elif field == 'content':
+                item['content'] = get_post_content(post)
+            elif field == 'html':
+                item['html'] = get_post_html(post['id'], lambda: get_post_content(post))
+            else:
+                item[field] = post[field]
+        result.append(item)
+    return result
+
+# 生成JSON接口的响应，支持ETag条件请求和gzip压缩
+def api_response(data):
+    response = jsonify(data)
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest(), weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.make_conditional(request)
+    
+    if (response.status_code == 200
+            and 'gzip' in request.headers.get('Accept-Encoding', '')
+            and len(response.get_data()) >= app.config['API_GZIP_MIN_SIZE']):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# 文章列表JSON接口
+@app.route('/api/posts')
+@rate_limited(lambda: ['search'] if request.args.get('search') else [])
+def api_posts():
+    fields = parse_api_fields(API_DEFAULT_LIST_FIELDS)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), app.config['API_MAX_LIMIT'])
+    search_query = request.args.get('search', '')
+    tag_filters = get_tag_filters()
+    cursor = request.args.get('cursor', '')
+    
+    # 只在需要时读取正文
+    columns = POST_LIST_COLUMNS
+    if 'content' in fields or 'html' in fields:
+        columns += ', p.content, p.content_encoding'
+    
+    # 与首页使用相同的筛选条件
+    conn = get_db_connection()
+    if tag_filters['tag'] or tag_filters['any_tag'] or tag_filters['not_tag']:
+        # 标签筛选使用倒排索引，游标之后的文章也在索引中定位
+        post_ids = query_tagged_post_ids(conn, tag_filters, search_query, before=decode_cursor(cursor))
+        posts = fetch_posts_by_ids(conn, post_ids[:limit], columns)
+        next_cursor = encode_cursor(posts[-1]) if len(post_ids) > limit and posts else None
+    else:
+        where = '1'
+        params = ()
+        if search_query:
+            where += ' AND (p.title LIKE ? OR post_content(p.content, p.content_encoding) LIKE ?)'
+            params += (f'%{search_query}%', f'%{search_query}%')
+        posts, next_cursor = query_post_page(conn, where, params, cursor, limit, columns)
+    data = {'posts': serialize_api_posts(conn, posts, fields), 'next_cursor': next_cursor}
+    conn.close()
+    return api_response(data)
+
+# 单篇文章JSON接口
+@app.route('/api/posts/<int:post_id>')
+def api_post(post_id):
+    fields = parse_api_fields(API_DEFAULT_LIST_FIELDS + ('content',))
+    conn = get_db_connection()
+    post = conn.execute('''
+        SELECT p.*, u.username
+        FROM posts p
+        LEFT JOIN users u ON p.author_id = u.id
+        WHERE p.id = ?
+    ''', (post_id,)).fetchone()
+    
+    if post is None:
+        conn.close()
+        return jsonify({'error': '文章不存在'}), 404
+    
+    data = serialize_api_posts(conn, [post], fields)[0]
+    conn.close()
+    return api_response(data)
+
+# 标签列表JSON接口
+@app.route('/api/tags')
+def api_tags():
+    conn = get_db_connection()
+    tags = conn.execute('''
+        SELECT t.id, t.name, COUNT(p.id) AS post_count
+        FROM tags t
+        LEFT JOIN post_tags pt ON pt.tag_id = t.id
+        LEFT JOIN posts p ON p.id = pt.post_id
+        GROUP BY t.id
+        ORDER BY t.name
+    ''').fetchall()
+    conn.close()
+    return api_response({'tags': [dict(tag) for tag in tags]})
+
 # 删除博客文章路由
 @app.route('/delete/<int:post_id>', methods=['POST'])
 @login_required
@@ -613,8 +1784,12 @@ def delete(post_id):
     try:
         # 在成功提交删除后添加日志
         conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+        conn.execute('DELETE FROM post_revisions WHERE post_id = ?', (post_id,))
+        update_related_posts(conn, post_id)
+        update_archive_count(conn, post['author_id'], post['created_at'], -1)
         logger.info(f'用户 {session["user_id"]} 删除了文章 {post_id}，标题：{post["title"]}')
         conn.commit()
+        tag_index.remove_post(post_id, fragment_cache.invalidate())
         flash('文章已删除')
     except Exception as e:
         conn.rollback()
@@ -635,6 +1810,27 @@ def first_five_lines(html_content):
         first_five += '\n<p>...</p>'
     return first_five
 
+# 将Markdown渲染为HTML
+@app.template_filter('markdown')
+def render_markdown(content):
+    return md.render(content)
+
+# 渲染可缓存的页面片段
+@app.template_global()
+def cached_fragment(name, key, render, *args):
+    """在模板中读取片段缓存，未命中时调用宏render渲染
+    
+    Args:
+        name: 片段名称
+        key: 决定片段内容的全部参数，作为缓存键的一部分
+        render: 渲染片段的宏
+        args: 传给宏的参数
+    """
+    if not app.config['FRAGMENT_CACHE_ENABLED']:
+        return render(*args)
+    cache_key = f'{name}:' + json.dumps(key, ensure_ascii=False, default=str)
+    return Markup(fragment_cache.get_or_render(cache_key, lambda: render(*args), g.get('fragment_generation')))
+
 # 添加上下文处理器，使datetime在所有模板中可用
 @app.context_processor
 def inject_datetime():
@@ -650,10 +1846,117 @@ def inject_datetime():
 def about():
     return render_template('about.html')
 
+# 限流统计接口（仅管理员可访问）
+@app.route('/admin/rate-limits')
+@admin_required
+def rate_limit_stats():
+    return jsonify(rate_limiter.stats())
+
+# 片段缓存统计接口（仅管理员可访问）
+@app.route('/admin/fragment-cache')
+@admin_required
+def fragment_cache_stats():
+    return jsonify(fragment_cache.stats())
+
+# 分批压缩已有文章的正文：flask --app app compress-posts
+@app.cli.command('compress-posts')
+@click.option('--batch-size', default=200, help='每批处理的文章数量')
+def compress_posts_command(batch_size):
+    """将超过阈值的未压缩正文分批压缩，每批单独提交，避免长时间锁住数据库"""
+    init_db()
+    conn = get_db_connection()
+    try:
+        start = datetime.now()
+        last_id = 0
+        compressed = 0
+        saved = 0
+        while True:
+            rows = conn.execute('''
+                SELECT id, content FROM posts
+                WHERE id > ? AND content_encoding IS NULL AND length(CAST(content AS BLOB)) >= ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, app.config['CONTENT_COMPRESSION_THRESHOLD'], batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                stored_content, content_encoding = encode_post_content(row['content'])
+                if content_encoding:
+                    conn.execute('UPDATE posts SET content = ?, content_encoding = ? WHERE id = ?',
+                                 (stored_content, content_encoding, row['id']))
+                    compressed += 1
+                    saved += len(row['content'].encode('utf-8')) - len(stored_content)
+            conn.commit()
+            last_id = rows[-1]['id']
+        elapsed = (datetime.now() - start).total_seconds()
+        print(f'已压缩 {compressed} 篇文章，节省 {saved / 1024:.1f} KB，耗时 {elapsed:.2f} 秒')
+        print('执行 db_manager.py 中的 VACUUM 可以回收释放的空间')
+    finally:
+        conn.close()
+
+# 性能分析汇总与运行时配置接口（仅管理员可访问）
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+@admin_required
+def profile_summary():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        try:
+            profiler.configure(enabled=data.get('enabled'),
+                               sample_rate=data.get('sample_rate'),
+                               mode=data.get('mode'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        logger.info(f'性能分析配置已修改：启用 {profiler.enabled}，采样比例 {profiler.sample_rate}，模式 {profiler.mode}')
+    elif request.method == 'DELETE':
+        profiler.reset()
+    return jsonify(profiler.summary())
+
+# 下载某个路由的cProfile统计（可用pstats或snakeviz打开）
+@app.route('/admin/profile/<endpoint>.pstats')
+@admin_required
+def profile_pstats(endpoint):
+    data = profiler.pstats_data(endpoint)
+    if data is None:
+        abort(404)
+    response = make_response(data)
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers['Content-Disposition'] = f'attachment; filename={endpoint}.pstats'
+    return response
+
+# 下载某个路由的折叠栈（可用flamegraph.pl或speedscope生成火焰图）
+@app.route('/admin/profile/<endpoint>.collapsed')
+@admin_required
+def profile_collapsed(endpoint):
+    data = profiler.collapsed_stacks(endpoint)
+    if data is None:
+        abort(404)
+    response = make_response(data)
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    response.headers['Content-Disposition'] = f'attachment; filename={endpoint}.collapsed'
+    return response
+
+# 离线全量重建相关文章索引：flask --app app rebuild-related
+@app.cli.command('rebuild-related')
+def rebuild_related_command():
+    """全量重建相关文章索引"""
+    init_db()
+    conn = get_db_connection()
+    try:
+        start = datetime.now()
+        count = rebuild_related_posts(conn)
+        elapsed = (datetime.now() - start).total_seconds()
+        print(f'已重建 {count} 篇文章的相关文章索引，耗时 {elapsed:.2f} 秒')
+    finally:
+        conn.close()
+
 if __name__ == '__main__':
     # 确保templates和static文件夹存在
     os.makedirs('templates', exist_ok=True)
     os.makedirs('static/css', exist_ok=True)
     # 初始化数据库
     init_db()
+    # 构建标签倒排索引
+    conn = get_db_connection()
+    tag_index.build(conn, fragment_cache.generation())
+    conn.close()
     app.run(debug=True, port=80)
\ No newline at end of file
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文章正文压缩基准测试
+生成一批较长的技术文章，分别以不压缩和压缩两种方式写入临时数据库，
+对比数据库大小、页缓存可容纳的比例、实际的页缓存未命中次数以及列表页/文章页的读取延迟。
+
+用法：python bench_compression.py [文章数量]
+"""
+
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+# 在临时目录中运行，避免在当前目录生成日志和缓存文件
+WORK_DIR = tempfile.mkdtemp(prefix='blog_bench_')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORK_DIR)
+
+import app as blog
+
+# SQLite页缓存大小（KB），模拟内存有限的服务器
+CACHE_SIZE_KB = 8 * 1024
+
+WORDS = ('flask sqlite index query cache page request template render markdown python '
+         'worker latency throughput transaction commit rollback cursor session token '
+         'database table column row compress benchmark memory disk thread process').split()
+
+
+def make_post(rng):
+    """生成一篇约8-40KB的Markdown技术文章"""
+    parts = []
+    for section in range(rng.randint(4, 12)):
+        parts.append(f"## 第{section + 1}节 {' '.join(rng.choices(WORDS, k=4))}\n")
+        for _ in range(rng.randint(3, 8)):
+            parts.append(' '.join(rng.choices(WORDS, k=rng.randint(40, 90))) + '\n')
+        code = '\n'.join(f"    {rng.choice(WORDS)} = {rng.choice(WORDS)}({rng.randint(0, 999)})"
+                         for _ in range(rng.randint(5, 20)))
+        parts.append(f"```python\ndef {rng.choice(WORDS)}():\n{code}\n```\n")
+    return '\n'.join(parts)
+
+
+def build_db(path, posts, compress):
+    blog.app.config['CONTENT_COMPRESSION'] = compress
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            content_encoding TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            author_id INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_posts_created ON posts (created_at, id)')
+    for i, content in enumerate(posts):
+        stored_content, content_encoding = blog.encode_post_content(content)
+        conn.execute('INSERT INTO posts (title, content, content_encoding, created_at) VALUES (?, ?, ?, ?)',
+                     (f'文章 {i}', stored_content, content_encoding, f'2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}'))
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+
+def read_chars():
+    """返回当前进程通过read系统调用读取的总字节数（仅Linux），SQLite页缓存未命中时才会读取文件"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(path, post_count, rng):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+
+    # 列表页：按时间倒序读取10篇文章并取出正文
+    list_times = []
+    start_chars = read_chars()
+    for _ in range(200):
+        offset = rng.randrange(0, max(1, post_count - 10))
+        start = time.perf_counter()
+        rows = conn.execute('SELECT * FROM posts ORDER BY created_at DESC LIMIT 10 OFFSET ?', (offset,)).fetchall()
+        for row in rows:
+            blog.get_post_content(row)
+        list_times.append((time.perf_counter() - start) * 1000)
+
+    list_chars = read_chars()
+
+    # 文章页：随机读取单篇文章
+    post_times = []
+    for _ in range(2000):
+        post_id = rng.randint(1, post_count)
+        start = time.perf_counter()
+        row = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+        blog.get_post_content(row)
+        post_times.append((time.perf_counter() - start) * 1000)
+
+    post_chars = read_chars()
+
+    conn.close()
+    cache_pages = CACHE_SIZE_KB * 1024 // page_size
+    return {
+        'size': os.path.getsize(path),
+        'pages': page_count,
+        # 页缓存大小与数据库页数之比，是计算值而不是实测的命中率
+        'cache_capacity': min(1.0, cache_pages / page_count),
+        # 实测的页缓存未命中：平均每次读取从数据库文件读入的页数
+        'list_misses': (list_chars - start_chars) / page_size / 200 if start_chars is not None else None,
+        'post_misses': (post_chars - list_chars) / page_size / 2000 if start_chars is not None else None,
+        'list_ms': statistics.median(list_times),
+        'post_ms': statistics.median(post_times),
+        'post_p95_ms': sorted(post_times)[int(len(post_times) * 0.95)],
+    }
+
+
+def main():
+    post_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = random.Random(42)
+    posts = [make_post(rng) for _ in range(post_count)]
+    raw_size = sum(len(p.encode('utf-8')) for p in posts)
+    print(f"文章数量: {post_count}，正文总大小: {raw_size / 1024 / 1024:.1f} MB，"
+          f"压缩阈值: {blog.app.config['CONTENT_COMPRESSION_THRESHOLD']} 字节，"
+          f"SQLite页缓存: {CACHE_SIZE_KB // 1024} MB")
+
+    results = {}
+    for label, compress in (('不压缩', False), ('zlib压缩', True)):
+        path = os.path.join(WORK_DIR, f'bench_{int(compress)}.db')
+        build_db(path, posts, compress)
+        results[label] = measure(path, post_count, random.Random(7))
+
+    print(f"\n{'':<10} {'数据库大小':>12} {'页数':>8} {'页缓存可容纳比例':>14} {'列表页未命中页数':>14} {'文章页未命中页数':>14} "
+          f"{'列表页中位数':>12} {'文章页中位数':>12} {'文章页P95':>10}")
+    for label, r in results.items():
+        misses = (f"{r['list_misses']:>16.1f} {r['post_misses']:>16.2f}" if r['post_misses'] is not None
+                  else f"{'-':>16} {'-':>16}")
+        print(f"{label:<10} {r['size'] / 1024 / 1024:>10.1f}MB {r['pages']:>8} {r['cache_capacity']:>16.1%} {misses} "
+              f"{r['list_ms']:>10.3f}ms {r['post_ms']:>10.3f}ms {r['post_p95_ms']:>8.3f}ms")
+    print("\n未命中页数：平均每次读取从数据库文件读入的页数（SQLite页缓存未命中），通过/proc/self/io统计")
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
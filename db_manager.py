@@ -3,10 +3,13 @@
 """
 博客用户数据库管理工具
 功能：列出用户、创建用户、删除用户、修改密码
+数据库维护：在线备份、VACUUM、ANALYZE、完整性检查、清理孤立数据
 """
 
+import os
 import sqlite3
 import sys
+import time
 import getpass
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -21,6 +24,24 @@ def get_db_connection():
         print(f"数据库连接错误: {e}")
         sys.exit(1)
 
+def table_exists(conn, name):
+    """检查数据库中是否存在指定的表"""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    return row is not None
+
+def invalidate_fragment_cache():
+    """使博客应用的页面片段缓存失效（文章卡片中包含作者信息）"""
+    if not os.path.exists('fragment_cache.db'):
+        return
+    try:
+        # 用户的文章已经删除，必须等到失效成功，不能因为缓存正忙而放弃
+        cache = sqlite3.connect('fragment_cache.db', timeout=30)
+        cache.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+        cache.commit()
+        cache.close()
+    except sqlite3.Error as e:
+        print(f"页面片段缓存失效失败: {e}")
+
 def list_users():
     """列出所有用户"""
     conn = get_db_connection()
@@ -139,10 +160,20 @@ def delete_user():
         # 删除相关的文章（如果需要保留文章可以注释掉这行）
         cursor.execute('UPDATE posts SET author_id = NULL WHERE author_id = ?', (user_id,))
         
+        # 将该用户的归档统计合并到"未知作者"（author_id为0）下
+        if table_exists(conn, 'archive_counts'):
+            cursor.execute('''
+                INSERT INTO archive_counts (author_id, year, month, post_count)
+                SELECT 0, year, month, post_count FROM archive_counts WHERE author_id = ?
+                ON CONFLICT (author_id, year, month) DO UPDATE SET post_count = post_count + excluded.post_count
+            ''', (user_id,))
+            cursor.execute('DELETE FROM archive_counts WHERE author_id = ?', (user_id,))
+        
         # 删除用户
         cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
         
         conn.commit()
+        invalidate_fragment_cache()
         print(f"\n用户 '{username}' 已成功删除！\n")
         
     except sqlite3.Error as e:
@@ -206,6 +237,222 @@ def change_password():
     finally:
         conn.close()
 
+def format_size(size):
+    """格式化字节数"""
+    if size < 1024:
+        return f"{size} B"
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}"
+
+def get_db_stats(conn, path='blog.db'):
+    """获取数据库文件大小和页使用情况"""
+    file_size = sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return {
+        'file_size': file_size,
+        'page_count': page_count,
+        'freelist_count': freelist_count,
+        'free_size': freelist_count * page_size,
+    }
+
+def print_report(title, before, after, elapsed):
+    """打印维护操作前后的耗时和大小对比"""
+    print(f"\n=== {title} ===")
+    print(f"耗时: {elapsed:.2f} 秒")
+    print(f"{'':<12} {'操作前':<15} {'操作后':<15}")
+    print(f"{'文件大小':<12} {format_size(before['file_size']):<15} {format_size(after['file_size']):<15}")
+    print(f"{'总页数':<12} {before['page_count']:<15} {after['page_count']:<15}")
+    print(f"{'空闲页':<12} {before['freelist_count']:<15} {after['freelist_count']:<15}")
+    print(f"{'空闲空间':<12} {format_size(before['free_size']):<15} {format_size(after['free_size']):<15}\n")
+
+def backup_database():
+    """在线备份数据库
+    
+    使用sqlite3的backup接口，每次只复制一小批页并在批次之间短暂休眠，
+    备份过程中博客应用仍然可以正常读写数据库。
+    """
+    default_path = f"blog_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    dest_path = input(f"请输入备份文件路径 (默认 {default_path}): ").strip() or default_path
+    if os.path.exists(dest_path):
+        print("备份文件已存在！")
+        return
+    
+    conn = get_db_connection()
+    try:
+        before = get_db_stats(conn)
+        dest = sqlite3.connect(dest_path)
+        
+        def progress(status, remaining, total):
+            print(f"\r备份进度: {total - remaining}/{total} 页", end='')
+        
+        start = time.perf_counter()
+        try:
+            conn.backup(dest, pages=256, progress=progress, sleep=0.005)
+        finally:
+            dest.close()
+        elapsed = time.perf_counter() - start
+        
+        print()
+        print_report("在线备份", before, get_db_stats(conn), elapsed)
+        print(f"备份文件: {dest_path} ({format_size(os.path.getsize(dest_path))})\n")
+        
+    except sqlite3.Error as e:
+        print(f"备份数据库出错: {e}")
+    finally:
+        conn.close()
+
+def vacuum_database():
+    """整理数据库文件，回收已删除数据占用的空间"""
+    print("1. 完整VACUUM（重建整个数据库文件，期间会阻塞写操作）")
+    print("2. 增量VACUUM（只回收空闲页，可以分多次执行）")
+    choice = input("请选择 (1-2): ").strip()
+    if choice not in ('1', '2'):
+        print("无效的选择！")
+        return
+    
+    conn = get_db_connection()
+    try:
+        before = get_db_stats(conn)
+        
+        if choice == '1':
+            start = time.perf_counter()
+            conn.execute('VACUUM')
+            title = "完整VACUUM"
+        else:
+            # 增量VACUUM要求数据库处于auto_vacuum=INCREMENTAL模式
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                confirm = input("数据库未启用增量VACUUM，需要先执行一次完整VACUUM来切换模式，是否继续？(y/n): ").lower()
+                if confirm != 'y':
+                    print("已取消操作。")
+                    return
+            
+            try:
+                pages = int(input("请输入本次最多回收的页数 (默认全部): ").strip() or 0)
+            except ValueError:
+                print("无效的页数！")
+                return
+            
+            start = time.perf_counter()
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+            # incremental_vacuum每执行一步只释放一个页，而sqlite3模块对没有结果列的语句只执行一步
+            # （fetchall()也不会继续执行），因此通过executescript执行到底
+            conn.commit()
+            conn.executescript(f'PRAGMA incremental_vacuum({pages});' if pages > 0 else 'PRAGMA incremental_vacuum;')
+            title = "增量VACUUM"
+        
+        elapsed = time.perf_counter() - start
+        print_report(title, before, get_db_stats(conn), elapsed)
+        
+    except sqlite3.Error as e:
+        print(f"VACUUM出错: {e}")
+    finally:
+        conn.close()
+
+def analyze_database():
+    """更新查询优化器使用的统计信息"""
+    conn = get_db_connection()
+    try:
+        before = get_db_stats(conn)
+        start = time.perf_counter()
+        conn.execute('ANALYZE')
+        conn.execute('PRAGMA optimize')
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        print_report("ANALYZE / PRAGMA optimize", before, get_db_stats(conn), elapsed)
+        
+    except sqlite3.Error as e:
+        print(f"ANALYZE出错: {e}")
+    finally:
+        conn.close()
+
+def check_integrity():
+    """检查数据库完整性和外键约束"""
+    conn = get_db_connection()
+    try:
+        before = get_db_stats(conn)
+        start = time.perf_counter()
+        problems = [row[0] for row in conn.execute('PRAGMA integrity_check').fetchall()]
+        fk_problems = conn.execute('PRAGMA foreign_key_check').fetchall()
+        elapsed = time.perf_counter() - start
+        print_report("完整性检查", before, get_db_stats(conn), elapsed)
+        
+        if problems == ['ok']:
+            print("数据库结构完整性: 正常")
+        else:
+            print("数据库结构完整性: 发现问题")
+            for problem in problems:
+                print(f"  - {problem}")
+        
+        if not fk_problems:
+            print("外键约束: 正常\n")
+        else:
+            # 按表统计违反外键约束的行数
+            counts = {}
+            for row in fk_problems:
+                key = (row[0], row[2])
+                counts[key] = counts.get(key, 0) + 1
+            print("外键约束: 发现孤立数据（可使用'清理孤立数据'修复）")
+            for (table, parent), count in counts.items():
+                print(f"  - {table} 中有 {count} 行引用了不存在的 {parent} 记录")
+            print()
+        
+    except sqlite3.Error as e:
+        print(f"完整性检查出错: {e}")
+    finally:
+        conn.close()
+
+def cleanup_orphans():
+    """清理孤立的文章标签关联和未使用的标签
+    
+    数据库没有启用外键约束，删除文章后post_tags中的关联不会自动删除。
+    """
+    conn = get_db_connection()
+    try:
+        before = get_db_stats(conn)
+        start = time.perf_counter()
+        
+        conn.execute('BEGIN TRANSACTION')
+        orphan_links = conn.execute('''
+            DELETE FROM post_tags
+            WHERE post_id NOT IN (SELECT id FROM posts) OR tag_id NOT IN (SELECT id FROM tags)
+        ''').rowcount
+        unused_tags = conn.execute('DELETE FROM tags WHERE id NOT IN (SELECT tag_id FROM post_tags)').rowcount
+        orphan_related = 0
+        if table_exists(conn, 'related_posts'):
+            orphan_related = conn.execute('''
+                DELETE FROM related_posts
+                WHERE post_id NOT IN (SELECT id FROM posts) OR related_id NOT IN (SELECT id FROM posts)
+            ''').rowcount
+        orphan_revisions = 0
+        if table_exists(conn, 'post_revisions'):
+            orphan_revisions = conn.execute(
+                'DELETE FROM post_revisions WHERE post_id NOT IN (SELECT id FROM posts)').rowcount
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        
+        # 标签云中包含标签列表
+        if unused_tags:
+            invalidate_fragment_cache()
+        
+        print_report("清理孤立数据", before, get_db_stats(conn), elapsed)
+        print(f"删除孤立的文章标签关联: {orphan_links} 条")
+        print(f"删除未使用的标签: {unused_tags} 个")
+        print(f"删除失效的相关文章记录: {orphan_related} 条")
+        print(f"删除已删除文章的历史版本: {orphan_revisions} 条")
+        print("(删除数据释放的空间需要执行VACUUM才能回收)\n")
+        
+    except sqlite3.Error as e:
+        print(f"清理孤立数据出错: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
 def main():
     """主函数"""
     print("=== 博客用户数据库管理工具 ===")
@@ -217,9 +464,14 @@ def main():
         print("2. 创建新用户")
         print("3. 删除用户")
         print("4. 修改用户密码")
+        print("5. 在线备份数据库")
+        print("6. 整理数据库 (VACUUM)")
+        print("7. 更新统计信息 (ANALYZE)")
+        print("8. 完整性检查")
+        print("9. 清理孤立数据")
         print("0. 退出")
         
-        choice = input("请输入选择 (0-4): ").strip()
+        choice = input("请输入选择 (0-9): ").strip()
         
         if choice == '1':
             list_users()
@@ -229,6 +481,16 @@ def main():
             delete_user()
         elif choice == '4':
             change_password()
+        elif choice == '5':
+            backup_database()
+        elif choice == '6':
+            vacuum_database()
+        elif choice == '7':
+            analyze_database()
+        elif choice == '8':
+            check_integrity()
+        elif choice == '9':
+            cleanup_orphans()
         elif choice == '0':
             print("\n感谢使用，再见！")
             break
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+页面片段缓存
+功能：缓存渲染好的页面片段（文章卡片、标签云、分页导航等），
+数据保存在本地SQLite文件中，同一台机器上的所有worker进程共享，重启后依然有效；
+另外提供一个进程内的LRU缓存
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FragmentCache:
+    """按大小限制、LRU淘汰的共享片段缓存
+
+    每个片段记录写入时的全局代数（generation），文章发生变化时只需把
+    代数加一，旧代数的片段就不再命中，随后被新的内容覆盖或被LRU淘汰。
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, busy_timeout=0.05, touch_interval=5,
+                 invalidate_timeout=10):
+        """
+        Args:
+            path: SQLite文件路径
+            max_bytes: 缓存内容的总大小上限
+            busy_timeout: 等待其他进程写锁的最长时间（秒），超时按未命中处理
+            touch_interval: 命中时更新访问时间的最小间隔（秒），减少写操作
+            invalidate_timeout: 失效操作等待写锁的最长时间（秒）
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.busy_timeout = busy_timeout
+        self.touch_interval = touch_interval
+        self.invalidate_timeout = invalidate_timeout
+        self._pending_invalidation = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        conn = self._connect()
+        conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS fragments (
+                key TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_fragments_access ON fragments (last_access);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 1);
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('total_bytes', 0);
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('hits', 0);
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('misses', 0);
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('evictions', 0);
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def generation(self):
+        """返回当前的缓存代数"""
+        return self._connect().execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+
+    def invalidate(self):
+        """使所有已缓存的片段失效（代数加一）
+
+        数据已经提交后必须让旧片段失效，因此这里不像读写片段那样快速放弃，
+        而是最多等待invalidate_timeout秒。仍然失败时，本进程在失效成功之前
+        不再读写缓存，并在之后每次访问缓存时重试。
+
+        Returns:
+            新的代数，失败时返回None
+        """
+        generation = self._bump_generation(self.invalidate_timeout)
+        if generation is None:
+            logger.error('片段缓存失效失败，在重试成功之前本进程不使用缓存')
+        return generation
+
+    def _bump_generation(self, timeout):
+        conn = self._connect()
+        conn.execute(f'PRAGMA busy_timeout = {int(timeout * 1000)}')
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+                generation = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.OperationalError as e:
+            logger.warning(f'递增片段缓存代数失败: {e}')
+            self._pending_invalidation = True
+            return None
+        finally:
+            conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+        self._pending_invalidation = False
+        return generation
+
+    def _usable(self):
+        # 上一次失效没有成功时先重试（只等待很短的时间），成功之前按未命中处理
+        return not self._pending_invalidation or self._bump_generation(self.busy_timeout) is not None
+
+    def get(self, key):
+        """读取当前代数下的片段，未命中时返回None"""
+        if not self._usable():
+            self._record(False)
+            return None
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute('''
+                SELECT value, last_access FROM fragments
+                WHERE key = ? AND generation = (SELECT value FROM meta WHERE name = 'generation')
+            ''', (key,)).fetchone()
+            if row and now - row[1] > self.touch_interval:
+                conn.execute('UPDATE fragments SET last_access = ? WHERE key = ?', (now, key))
+        except sqlite3.OperationalError as e:
+            logger.warning(f'读取片段缓存失败: {e}')
+            row = None
+        self._record(row is not None)
+        return row[0] if row else None
+
+    def set(self, key, value, generation=None):
+        """写入片段，超过大小上限时按最近访问时间淘汰旧片段
+
+        Args:
+            generation: 读取生成片段所用的数据之前的代数。如果之后代数发生了变化，
+                片段可能是用旧数据渲染的，不写入缓存。为None时使用当前代数
+        """
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes or not self._usable():
+            return
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            # 其他进程正在写入时直接放弃本次缓存，不阻塞请求
+            logger.warning(f'写入片段缓存失败: {e}')
+            return
+        try:
+            current = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+            if generation is not None and generation != current:
+                conn.execute('ROLLBACK')
+                return
+            old = conn.execute('SELECT size FROM fragments WHERE key = ?', (key,)).fetchone()
+            conn.execute('''
+                INSERT OR REPLACE INTO fragments (key, generation, value, size, last_access)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (key, current, value, size, now))
+            conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_bytes'",
+                         (size - (old[0] if old else 0),))
+            total = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(conn, total - int(self.max_bytes * 0.9))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn, needed):
+        """淘汰最久未访问的片段，直到释放needed字节"""
+        freed = 0
+        evicted = 0
+        while freed < needed:
+            rows = conn.execute('SELECT key, size FROM fragments ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                conn.execute('DELETE FROM fragments WHERE key = ?', (key,))
+                freed += size
+                evicted += 1
+                if freed >= needed:
+                    break
+        conn.execute("UPDATE meta SET value = value - ? WHERE name = 'total_bytes'", (freed,))
+        conn.execute("UPDATE meta SET value = value + ? WHERE name = 'evictions'", (evicted,))
+
+    def get_or_render(self, key, render, generation=None):
+        """读取片段，未命中时调用render生成并写入缓存
+
+        Args:
+            generation: 读取渲染所需数据之前的代数，见set()
+        """
+        value = self.get(key)
+        if value is None:
+            value = str(render())
+            try:
+                self.set(key, value, generation)
+            except sqlite3.OperationalError as e:
+                logger.warning(f'写入片段缓存失败: {e}')
+        return value
+
+    def _record(self, hit):
+        # 命中统计先在进程内累计，攒够一批再写入共享的统计表
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            pending = self._hits + self._misses
+        if pending >= 100:
+            self.flush_stats()
+
+    def flush_stats(self):
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            self._hits = self._misses = 0
+        if not hits and not misses:
+            return
+        try:
+            conn = self._connect()
+            conn.execute("UPDATE meta SET value = value + ? WHERE name = 'hits'", (hits,))
+            conn.execute("UPDATE meta SET value = value + ? WHERE name = 'misses'", (misses,))
+        except sqlite3.OperationalError:
+            # 写入失败时放回进程内计数，下次再写
+            with self._lock:
+                self._hits += hits
+                self._misses += misses
+
+    def stats(self):
+        """返回所有worker进程汇总的命中统计和缓存占用"""
+        self.flush_stats()
+        conn = self._connect()
+        stats = dict(conn.execute('SELECT name, value FROM meta').fetchall())
+        stats['entries'] = conn.execute('SELECT COUNT(*) FROM fragments').fetchone()[0]
+        stats['max_bytes'] = self.max_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+class LRUCache:
+    """进程内的LRU缓存，用于缓存体积小、计算快但调用频繁的结果
+
+    同时限制条目数量和内容的总大小（UTF-8字节数），超过max_item_bytes的值不缓存，
+    避免少数很大的值占满内存。
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, max_item_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = len(value.encode('utf-8')) if isinstance(value, str) else 0
+        if self.max_item_bytes is not None and size > self.max_item_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._data[key] = (value, size)
+            self.total_bytes += size
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def get_or_render(self, key, render):
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
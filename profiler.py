@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按需请求性能分析
+功能：按采样比例或管理员请求头对单个请求做性能分析，按路由汇总结果，
+可以导出为pstats文件（cProfile）或火焰图使用的折叠栈格式（栈采样）
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+# 管理员通过此请求头要求分析当前请求
+PROFILE_HEADER = 'X-Profile'
+
+
+class StackSampler:
+    """定时采样被分析线程的调用栈，开销与请求中调用的函数数量无关"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id, counts):
+        """开始采样指定线程，采样结果累加到counts（折叠栈 -> 次数）"""
+        with self._lock:
+            self._active[thread_id] = counts
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, thread_id):
+        """停止采样指定线程，返回后采样线程不会再写入它的采样结果"""
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                # 先清除事件再读取，两步都在锁内完成：start()在读取之后加入的请求
+                # 一定会在清除之后再次设置事件，不会被漏掉
+                self._wakeup.clear()
+                active = dict(self._active)
+            if not active:
+                # 没有需要采样的请求时休眠，直到下一个请求开始
+                self._wakeup.wait()
+                continue
+            frames = sys._current_frames()
+            stacks = {thread_id: self._collapse(frames[thread_id]) for thread_id in active if thread_id in frames}
+            del frames
+            with self._lock:
+                # 在锁内累加，并且只写入仍在采样的请求：stop()返回后不会再修改它的计数
+                for thread_id, stack in stacks.items():
+                    counts = self._active.get(thread_id)
+                    if counts is active[thread_id]:
+                        counts[stack] += 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+
+class RequestProfiler:
+    """请求级性能分析器
+
+    通过app.config配置：
+        PROFILER_ENABLED: 是否按采样比例分析请求
+        PROFILER_SAMPLE_RATE: 被分析请求的比例（0-1）
+        PROFILER_MODE: 'cprofile'、'sample'或'both'
+        PROFILER_SAMPLE_INTERVAL: 栈采样间隔（秒）
+    未启用时每个请求只多一次属性判断和一次请求头查找。
+    """
+
+    def __init__(self, app=None, authorize=None):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.sampler = None
+        if app is not None:
+            self.init_app(app, authorize)
+
+    def init_app(self, app, authorize=None):
+        """
+        Args:
+            app: Flask应用
+            authorize: 判断当前请求能否通过请求头要求分析的函数（通常只允许管理员）
+        """
+        self.enabled = app.config.get('PROFILER_ENABLED', False)
+        self.sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0.01)
+        self.mode = app.config.get('PROFILER_MODE', 'cprofile')
+        self.authorize = authorize or (lambda: False)
+        self.sampler = StackSampler(app.config.get('PROFILER_SAMPLE_INTERVAL', 0.005))
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def configure(self, enabled=None, sample_rate=None, mode=None):
+        """运行时修改配置（只影响当前worker进程）"""
+        if enabled is not None:
+            self.enabled = str(enabled).lower() in ('1', 'true', 'on', 'yes')
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        if mode is not None:
+            if mode not in ('cprofile', 'sample', 'both'):
+                raise ValueError(f'未知的分析模式: {mode}')
+            self.mode = mode
+
+    def _should_profile(self):
+        if PROFILE_HEADER in request.headers:
+            return self.authorize()
+        return self.enabled and random.random() < self.sample_rate
+
+    def _before_request(self):
+        if not self.enabled and PROFILE_HEADER not in request.headers:
+            return
+        if not self._should_profile():
+            return
+
+        endpoint = request.endpoint or request.path
+        state = {'endpoint': endpoint, 'start': time.perf_counter(), 'profile': None, 'stacks': None}
+        if self.mode in ('cprofile', 'both'):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                state['profile'] = profile
+            except ValueError:
+                # 部分Python版本同一时间只允许一个cProfile分析器
+                logger.info(f'已有请求正在使用cProfile，跳过分析: {request.path}')
+        if self.mode in ('sample', 'both'):
+            state['stacks'] = Counter()
+            self.sampler.start(threading.get_ident(), state['stacks'])
+        g._profiler_state = state
+
+    def _teardown_request(self, exc):
+        state = g.pop('_profiler_state', None)
+        if state is None:
+            return
+        if state['profile'] is not None:
+            state['profile'].disable()
+        if state['stacks'] is not None:
+            self.sampler.stop(threading.get_ident())
+        elapsed = time.perf_counter() - state['start']
+
+        with self._lock:
+            result = self._endpoints.setdefault(state['endpoint'], {
+                'requests': 0, 'total_time': 0.0, 'max_time': 0.0, 'stats': None, 'stacks': Counter()
+            })
+            result['requests'] += 1
+            result['total_time'] += elapsed
+            result['max_time'] = max(result['max_time'], elapsed)
+            if state['profile'] is not None:
+                if result['stats'] is None:
+                    result['stats'] = pstats.Stats(state['profile'])
+                else:
+                    result['stats'].add(state['profile'])
+            if state['stacks']:
+                result['stacks'].update(state['stacks'])
+
+    def summary(self):
+        """返回各路由的分析汇总"""
+        with self._lock:
+            endpoints = {
+                endpoint: {
+                    'requests': result['requests'],
+                    'avg_ms': round(result['total_time'] / result['requests'] * 1000, 3),
+                    'max_ms': round(result['max_time'] * 1000, 3),
+                    'has_pstats': result['stats'] is not None,
+                    'samples': sum(result['stacks'].values()),
+                }
+                for endpoint, result in self._endpoints.items()
+            }
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'mode': self.mode,
+            'endpoints': endpoints,
+        }
+
+    def pstats_data(self, endpoint):
+        """返回可以用pstats.Stats加载的二进制数据，没有数据时返回None"""
+        with self._lock:
+            result = self._endpoints.get(endpoint)
+            if result is None or result['stats'] is None:
+                return None
+            return marshal.dumps(result['stats'].stats)
+
+    def collapsed_stacks(self, endpoint):
+        """返回折叠栈文本（每行“栈 次数”），可直接交给flamegraph.pl或speedscope，没有数据时返回None"""
+        with self._lock:
+            result = self._endpoints.get(endpoint)
+            if result is None or not result['stacks']:
+                return None
+            return ''.join(f'{stack} {count}\n' for stack, count in result['stacks'].most_common())
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
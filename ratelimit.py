@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求准入控制
+功能：按客户端IP和用户的令牌桶限流、全局并发数限制、准入/拒绝计数
+状态可以保存在进程内存中，也可以保存在本地SQLite文件中供多个worker进程共享
+"""
+
+import logging
+import math
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# 准入结果：status为None表示放行，否则为应返回的HTTP状态码
+Decision = namedtuple('Decision', ['status', 'retry_after', 'slots'])
+
+
+class MemoryBackend:
+    """进程内存后端，只在当前worker进程内生效"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = {}
+        self._counters = {}
+
+    def take(self, rule, keys, rate, burst):
+        """从多个令牌桶中各取一个令牌，任意一个桶为空时都不扣减
+
+        Returns:
+            0表示放行，否则为需要等待的秒数
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key in keys:
+                tokens, updated_at = self._buckets.get(key, (burst, now))
+                levels.append(min(burst, tokens + (now - updated_at) * rate))
+            wait = max([(1 - level) / rate for level in levels if level < 1] or [0])
+            if not wait:
+                for key, level in zip(keys, levels):
+                    self._buckets[key] = (level - 1, now)
+            self._count(rule, 'shed' if wait else 'admitted')
+            return wait
+
+    def acquire_slot(self, name, limit, lease):
+        with self._lock:
+            if self._slots.get(name, 0) >= limit:
+                self._count(name, 'shed_concurrency')
+                return None
+            self._slots[name] = self._slots.get(name, 0) + 1
+            return name
+
+    def release_slot(self, name, token):
+        with self._lock:
+            self._slots[name] = max(0, self._slots.get(name, 0) - 1)
+
+    def _count(self, rule, outcome):
+        self._counters[(rule, outcome)] = self._counters.get((rule, outcome), 0) + 1
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class SQLiteBackend:
+    """本地SQLite后端，同一台机器上的多个worker进程共享限流状态
+
+    每个操作都是一个短小的写事务，并且只等待很短的锁超时时间，
+    这样在高负载下请求会被快速处理，而不会在锁上排队。
+    """
+
+    def __init__(self, path, busy_timeout=0.05):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS slots (
+                token TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_slots_name ON slots (name, expires_at);
+            CREATE TABLE IF NOT EXISTS counters (
+                rule TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (rule, outcome)
+            );
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, rule, keys, rate, burst):
+        # 进程之间共享状态，必须使用墙上时间
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            for key in keys:
+                row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens, updated_at = row if row else (burst, now)
+                levels.append(min(burst, tokens + max(0.0, now - updated_at) * rate))
+            wait = max([(1 - level) / rate for level in levels if level < 1] or [0])
+            if not wait:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                    [(key, level - 1, now) for key, level in zip(keys, levels)]
+                )
+            self._count(conn, rule, 'shed' if wait else 'admitted')
+            # 偶尔清理早已回满的令牌桶，避免表无限增长
+            if random.random() < 0.001:
+                conn.execute('DELETE FROM buckets WHERE updated_at < ?', (now - 86400,))
+            conn.execute('COMMIT')
+            return wait
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def acquire_slot(self, name, limit, lease):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 租约过期的名额视为已释放（例如持有它的进程已崩溃）
+            conn.execute('DELETE FROM slots WHERE name = ? AND expires_at < ?', (name, now))
+            used = conn.execute('SELECT COUNT(*) FROM slots WHERE name = ?', (name,)).fetchone()[0]
+            token = None
+            if used < limit:
+                token = uuid.uuid4().hex
+                conn.execute('INSERT INTO slots (token, name, expires_at) VALUES (?, ?, ?)',
+                             (token, name, now + lease))
+            else:
+                self._count(conn, name, 'shed_concurrency')
+            conn.execute('COMMIT')
+            return token
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release_slot(self, name, token):
+        self._connect().execute('DELETE FROM slots WHERE token = ?', (token,))
+
+    def _count(self, conn, rule, outcome):
+        conn.execute('''
+            INSERT INTO counters (rule, outcome, count) VALUES (?, ?, 1)
+            ON CONFLICT (rule, outcome) DO UPDATE SET count = count + 1
+        ''', (rule, outcome))
+
+    def counters(self):
+        rows = self._connect().execute('SELECT rule, outcome, count FROM counters').fetchall()
+        return {(rule, outcome): count for rule, outcome, count in rows}
+
+
+class RateLimiter:
+    """按规则对请求做准入控制
+
+    规则通过app.config配置：
+        RATE_LIMITS: {规则名: (每秒补充的令牌数, 桶容量)}
+        RATE_LIMIT_CONCURRENCY: {规则名: 最大并发数}
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.config = app.config
+        if app.config.get('RATE_LIMIT_BACKEND') == 'sqlite':
+            self.backend = SQLiteBackend(app.config['RATE_LIMIT_DB'])
+        else:
+            self.backend = MemoryBackend()
+
+    def admit(self, rules, keys):
+        """检查一组规则，决定是否放行当前请求
+
+        Args:
+            rules: 适用于当前请求的规则名列表
+            keys: 限流维度，例如['ip:1.2.3.4', 'user:1']，每个维度一个令牌桶
+
+        Returns:
+            Decision；放行时其中的slots需要在请求结束后交给release释放
+        """
+        slots = []
+        if not self.config.get('RATE_LIMIT_ENABLED', True):
+            return Decision(None, 0, slots)
+        limits = self.config.get('RATE_LIMITS', {})
+        concurrency = self.config.get('RATE_LIMIT_CONCURRENCY', {})
+        try:
+            for rule in rules:
+                if rule in limits:
+                    rate, burst = limits[rule]
+                    wait = self.backend.take(rule, [f'{rule}:{key}' for key in keys], rate, burst)
+                    if wait:
+                        self.release(Decision(None, 0, slots))
+                        return Decision(429, math.ceil(wait), [])
+                if rule in concurrency:
+                    token = self.backend.acquire_slot(rule, concurrency[rule],
+                                                      self.config.get('RATE_LIMIT_SLOT_LEASE', 30))
+                    if token is None:
+                        self.release(Decision(None, 0, slots))
+                        return Decision(503, 1, [])
+                    slots.append((rule, token))
+        except sqlite3.OperationalError as e:
+            # 共享状态暂时不可用时放行请求，而不是让请求在锁上排队
+            logger.warning(f'限流状态不可用，放行请求: {e}')
+        return Decision(None, 0, slots)
+
+    def release(self, decision):
+        for name, token in decision.slots:
+            try:
+                self.backend.release_slot(name, token)
+            except sqlite3.OperationalError as e:
+                # 释放失败的名额会在租约过期后自动回收
+                logger.warning(f'释放并发名额失败: {e}')
+
+    def stats(self):
+        """返回各规则的放行和拒绝次数"""
+        stats = {}
+        for (rule, outcome), count in sorted(self.backend.counters().items()):
+            stats.setdefault(rule, {})[outcome] = count
+        return stats
@@ -0,0 +1,76 @@
+// Markdown实时预览：输入停止一段时间后才请求服务器，并复用已经渲染过的块
+(function () {
+    const DEBOUNCE_MS = 400;
+    const MAX_KNOWN_BLOCKS = 2000;
+
+    const textarea = document.getElementById('content');
+    const output = document.getElementById('preview-output');
+    const status = document.getElementById('preview-status');
+    if (!textarea || !output) {
+        return;
+    }
+
+    // 块哈希 -> 渲染好的HTML
+    const blockCache = new Map();
+    let timer = null;
+    let lastContent = null;
+    let controller = null;
+
+    function render(blocks) {
+        output.innerHTML = blocks.map(function (block) {
+            const html = block.html !== undefined ? block.html : blockCache.get(block.hash);
+            // Map按插入顺序遍历，使用过的块重新插入到末尾，淘汰时先删除最久未使用的块
+            blockCache.delete(block.hash);
+            blockCache.set(block.hash, html);
+            return html || '';
+        }).join('');
+
+        // 只保留最近使用的块，避免长时间编辑后占用过多内存
+        while (blockCache.size > MAX_KNOWN_BLOCKS) {
+            blockCache.delete(blockCache.keys().next().value);
+        }
+    }
+
+    function requestPreview() {
+        const content = textarea.value;
+        if (content === lastContent) {
+            return;
+        }
+        lastContent = content;
+
+        // 取消尚未返回的旧请求
+        if (controller) {
+            controller.abort();
+        }
+        controller = new AbortController();
+
+        fetch(output.dataset.url, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({content: content, known: Array.from(blockCache.keys())}),
+            signal: controller.signal
+        }).then(function (response) {
+            return response.json().then(function (data) {
+                if (!response.ok) {
+                    throw new Error(data.error || '预览失败');
+                }
+                return data;
+            });
+        }).then(function (data) {
+            render(data.blocks);
+            status.textContent = '';
+        }).catch(function (error) {
+            if (error.name !== 'AbortError') {
+                status.textContent = error.message;
+                lastContent = null;
+            }
+        });
+    }
+
+    textarea.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(requestPreview, DEBOUNCE_MS);
+    });
+
+    requestPreview();
+})();
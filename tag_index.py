@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内存标签倒排索引
+功能：保存每个标签对应的有序文章列表，支持多标签的AND / OR / NOT筛选，
+筛选、计数和分页都在内存中完成，不需要扫描post_tags关联表
+"""
+
+import heapq
+import threading
+from bisect import bisect_left, insort
+
+
+def _contains(keys, key):
+    """在有序列表中二分查找"""
+    i = bisect_left(keys, key)
+    return i < len(keys) and keys[i] == key
+
+
+class TagIndex:
+    """标签 -> 有序文章列表的倒排索引
+
+    列表中的元素是文章的排序键(created_at, id)，按升序保存，
+    倒序遍历即为首页的"最新优先"顺序。
+
+    索引保存在每个worker进程的内存中。generation记录索引对应的数据版本，
+    与共享的缓存代数不一致时说明其他进程修改过文章，需要重新构建。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._post_keys = {}
+        self._post_tags = {}
+        self._all = []
+        self.generation = None
+
+    def build(self, conn, generation):
+        """从posts和post_tags表全量构建索引"""
+        post_keys = {row[0]: (row[1] or '', row[0]) for row in conn.execute('SELECT id, created_at FROM posts')}
+        postings = {}
+        post_tags = {}
+        for post_id, name in conn.execute('''
+                SELECT pt.post_id, t.name FROM post_tags pt
+                JOIN tags t ON t.id = pt.tag_id'''):
+            # 跳过已删除文章遗留的关联
+            if post_id in post_keys:
+                postings.setdefault(name, []).append(post_keys[post_id])
+                post_tags.setdefault(post_id, set()).add(name)
+        for keys in postings.values():
+            keys.sort()
+
+        with self._lock:
+            self._postings = postings
+            self._post_keys = post_keys
+            self._post_tags = post_tags
+            self._all = sorted(post_keys.values())
+            self.generation = generation
+
+    def ensure_fresh(self, conn, generation):
+        """索引为空或已过期时重新构建"""
+        if self.generation != generation:
+            self.build(conn, generation)
+
+    def _remove(self, post_id):
+        key = self._post_keys.pop(post_id, None)
+        if key is None:
+            return
+        for name in self._post_tags.pop(post_id, ()):
+            keys = self._postings.get(name)
+            if keys and _contains(keys, key):
+                keys.pop(bisect_left(keys, key))
+                if not keys:
+                    del self._postings[name]
+        self._all.pop(bisect_left(self._all, key))
+
+    def update_post(self, post_id, created_at, tag_names, generation):
+        """文章创建或修改后增量更新索引
+
+        Args:
+            post_id: 文章ID
+            created_at: 文章创建时间（数据库中保存的值）
+            tag_names: 文章现在的标签名列表
+            generation: 本次修改后的缓存代数
+        """
+        with self._lock:
+            if not self._advance(generation):
+                return
+            self._remove(post_id)
+            key = (created_at or '', post_id)
+            self._post_keys[post_id] = key
+            self._post_tags[post_id] = set(tag_names)
+            insort(self._all, key)
+            for name in self._post_tags[post_id]:
+                insort(self._postings.setdefault(name, []), key)
+
+    def remove_post(self, post_id, generation):
+        """文章删除后增量更新索引"""
+        with self._lock:
+            if self._advance(generation):
+                self._remove(post_id)
+
+    def advance(self, generation):
+        """修改不涉及标签和创建时间时（例如恢复历史版本），直接把索引推进到新的代数"""
+        with self._lock:
+            self._advance(generation)
+
+    def _advance(self, generation):
+        # 只有本进程的索引恰好是上一个版本时才能增量更新，
+        # 否则说明中间有其他进程的修改，标记为过期，下次查询时重建
+        if self.generation is not None and generation is not None and generation == self.generation + 1:
+            self.generation = generation
+            return True
+        self.generation = None
+        return False
+
+    def query(self, all_tags=(), any_tags=(), not_tags=(), before=None):
+        """多标签筛选
+
+        Args:
+            all_tags: 必须全部包含的标签（AND）
+            any_tags: 至少包含其中一个的标签（OR）
+            not_tags: 不能包含的标签（NOT）
+            before: 分页游标位置(created_at, id)，只返回排在它之后（更早）的文章
+
+        Returns:
+            符合条件的文章ID列表，按创建时间从新到旧排序
+        """
+        with self._lock:
+            lists = [self._postings.get(name, []) for name in set(all_tags)]
+            if any_tags:
+                # 多个有序列表归并去重，结果仍然有序
+                merged = []
+                for key in heapq.merge(*(self._postings.get(name, []) for name in set(any_tags))):
+                    if not merged or merged[-1] != key:
+                        merged.append(key)
+                lists.append(merged)
+            if not lists:
+                lists.append(self._all)
+
+            # 从最短的列表开始，在其余列表中二分查找
+            lists.sort(key=len)
+            first = lists[0]
+            if before is not None:
+                first = first[:bisect_left(first, before)]
+            result = [key for key in first if all(_contains(other, key) for other in lists[1:])]
+
+            excluded = [self._postings[name] for name in set(not_tags) if name in self._postings]
+            if excluded:
+                result = [key for key in result if not any(_contains(keys, key) for keys in excluded)]
+
+        return [post_id for _, post_id in reversed(result)]